@@ -1,34 +1,43 @@
 import os
+import time
 from dotenv import load_dotenv
 
-from expense_data import make_expense_pdf, make_non_docs_expense_dict, make_income_pdf
-from google_services import activate_services, send_email_with_buffers_attachments
+from expense_data import make_expense_pdf, make_non_docs_expense_dict, make_income_pdf, PeriodSnapshot
+from google_services import get_credentials, activate_services, send_email_with_buffers_attachments
+from pipeline import run_graph
+from downloads import hedge_settings
 
 
-def report_to_accountant(start, end, year):
+def report_to_accountant(start, end, year, date=None, snapshot=None, progress=None):
     """
     This function puts together the periodic report mail to the accountant
     and sends the email, incl. two pdf (income and expenses) and adds the undocumented expenses
-    to the text of the email
+    to the text of the email.
+    All stages read the period data from one snapshot, so morning is queried once per document kind
+    (pass the page's snapshot to reuse data it already fetched).
+    progress is an optional function(stage, done, total) reporting the progress of the stages.
+    Both pdfs share one download deadline (REPORT_DEADLINE); if documents are still missing then,
+    downloads.MissingDocumentsError is raised and nothing is sent.
     """
     load_dotenv()
 
-    expense_buffer = make_expense_pdf()
-    non_docs_expenses_dict = make_non_docs_expense_dict()
-    income_buffer = make_income_pdf()
-
-    gmail, calendar = activate_services()
+    snapshot = snapshot or PeriodSnapshot()
+    _, report_deadline = hedge_settings()
+    deadline = time.monotonic() + report_deadline
 
     def make_body(non_docs_dict):
         return "\n".join(f"{key}: {value}" for key, value in non_docs_dict.items())
 
-    body_text = make_body(non_docs_expenses_dict)
+    def send(expense_buffer, non_docs_expenses_dict, income_buffer, _credentials):
+        # The services are per thread, so they are activated on the thread that uses them
+        gmail, calendar = activate_services()
+        body_text = make_body(non_docs_expenses_dict)
 
-    sender = os.getenv('SENDER')
-    to = os.getenv('TO')
-    cc = os.getenv('CC')
-    subject = f'Income and Expenditure for {start}-{end}, {year}'
-    body = f"""
+        sender = os.getenv('SENDER')
+        to = os.getenv('TO')
+        cc = os.getenv('CC')
+        subject = f'Income and Expenditure for {start}-{end}, {year}'
+        body = f"""
     היי יאיר
 
     מצ"ב הדו"ח התקופתי.
@@ -40,8 +49,23 @@ def report_to_accountant(start, end, year):
 
     דני
     """
-    file_buffers = [('income.pdf', income_buffer), ('expenses.pdf', expense_buffer)]
+        file_buffers = [('income.pdf', income_buffer), ('expenses.pdf', expense_buffer)]
+
+        if progress is not None:
+            progress('send', 0, 1)
 
-    send_email_with_buffers_attachments(gmail, sender, to, cc, subject, body, file_buffers)
+        send_email_with_buffers_attachments(gmail, sender, to, cc, subject, body, file_buffers)
 
+        if progress is not None:
+            progress('send', 1, 1)
 
+    # The income and expense branches and loading the Google credentials run concurrently,
+    # the expense data is fetched once by the snapshot for both expense tasks.
+    # Each pdf merges pages while its documents are still downloading.
+    run_graph({
+        'expense_pdf': (lambda: make_expense_pdf(date, snapshot, progress, deadline), []),
+        'non_docs': (lambda: make_non_docs_expense_dict(date, snapshot), []),
+        'income_pdf': (lambda: make_income_pdf(date, snapshot, progress, deadline), []),
+        'credentials': (get_credentials, []),
+        'send': (send, ['expense_pdf', 'non_docs', 'income_pdf', 'credentials']),
+    })
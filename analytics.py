@@ -0,0 +1,92 @@
+"""
+This file holds the columnar aggregation of morning documents for supplier and period analytics.
+
+Documents are flattened once into a pandas table with typed columns, and all the totals
+are vectorized group-bys on that table.
+"""
+
+import pandas as pd
+
+
+# Shown in place of a missing supplier name in the tables
+NO_SUPPLIER = '(no supplier)'
+
+
+def documents_frame(items):
+    """
+    Flattens morning expense docs into a table with the columns:
+    supplier (string), amount (number), whole_amount (bool, the amount was sent as an integer),
+    type (Int64), date (datetime64), has_doc (bool) and
+    period (string, the first day of the two-month reporting period of date).
+    """
+    suppliers = []
+    amounts = []
+    types = []
+    dates = []
+    has_docs = []
+    for item in items:
+        suppliers.append((item.get('supplier') or {}).get('name'))
+        amounts.append(item.get('amount', 0))
+        types.append(item.get('type'))
+        dates.append(item.get('date'))
+        has_docs.append('url' in item)
+
+    frame = pd.DataFrame({
+        'supplier': pd.Series(suppliers, dtype='string'),
+        'amount': pd.Series(amounts) if amounts else pd.Series(amounts, dtype='float64'),
+        # amount turns float64 as soon as one amount is a float, this keeps the type of each one
+        'whole_amount': pd.Series([isinstance(amount, int) for amount in amounts], dtype='bool'),
+        'type': pd.Series(types, dtype='Int64'),
+        'date': pd.to_datetime(pd.Series(dates, dtype='object'), errors='coerce'),
+        'has_doc': pd.Series(has_docs, dtype='bool'),
+    })
+
+    # Reporting periods: Jan-Feb, Mar-Apr, ... start on the odd months
+    start_month = ((frame['date'].dt.month - 1) // 2) * 2 + 1
+    frame['period'] = (frame['date'].dt.year.astype('Int64').astype('string') + '-'
+                       + start_month.astype('Int64').astype('string').str.zfill(2) + '-01')
+    return frame
+
+
+def group_totals(frame, by=('supplier',), has_doc=None):
+    """
+    Sums and counts the amounts by the given columns, in the order the groups first appear.
+    has_doc=True / False keeps only expenses with / without a document.
+    """
+    if has_doc is not None:
+        frame = frame[frame['has_doc'] == has_doc]
+    return frame.groupby(list(by), sort=False, dropna=False)['amount'].agg(['sum', 'count'])
+
+
+def non_docs_totals(frame):
+    """
+    {supplier: total amount} of the expenses without a document. A total is an int when all its amounts
+    were ints, like summing the docs in Python, also when other suppliers' amounts are floats.
+    """
+    frame = frame[~frame['has_doc']]
+    grouped = frame.groupby('supplier', sort=False, dropna=False)
+    totals, whole = grouped['amount'].sum(), grouped['whole_amount'].all()
+    return {(None if pd.isna(supplier) else supplier): (int(total) if whole[supplier] else float(total))
+            for supplier, total in totals.items()}
+
+
+def _dated(frame):
+    """ The docs that have a date, with NO_SUPPLIER for missing supplier names """
+    frame = frame.dropna(subset=['period'])
+    return frame.assign(supplier=frame['supplier'].fillna(NO_SUPPLIER))
+
+
+def supplier_period_totals(frame):
+    """ Table of total amounts, suppliers × reporting periods """
+    totals = group_totals(_dated(frame), by=('supplier', 'period'))['sum']
+    return totals.unstack('period', fill_value=0).sort_index(axis=1)
+
+
+def period_totals(frame):
+    """ Total amount and number of expenses per reporting period, sorted by period """
+    return group_totals(_dated(frame), by=('period',)).sort_index()
+
+
+def supplier_totals(frame):
+    """ Total amount and number of expenses per supplier, largest first """
+    return group_totals(_dated(frame)).sort_values('sum', ascending=False)
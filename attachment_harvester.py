@@ -0,0 +1,157 @@
+"""
+This file holds the Gmail attachment harvester.
+
+It fetches the attachments of all messages matching a Gmail query with a bounded pool of
+workers, writes them to disk deduplicated by content hash and records what was pulled,
+so that reruns only fetch new attachments.
+"""
+
+import os
+import json
+import base64
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import httplib2
+from google_auth_httplib2 import AuthorizedHttp
+from googleapiclient.errors import HttpError
+
+from google_services import get_credentials, list_message_ids
+from expense_data import expense_dict
+
+
+DEFAULT_WORKERS = 4
+MANIFEST_FILE = '.harvest.json'
+# Base64 text is decoded in chunks of this many characters (a multiple of 4)
+DECODE_CHUNK_SIZE = 4 * 16 * 1024
+
+
+def supplier_bills_query(suppliers=None, newer_than=None):
+    """
+    Returns a Gmail query for messages with attachments that mention one of the suppliers
+    (by default the suppliers of expense_dict), e.g. newer_than='6m'.
+    """
+    suppliers = suppliers or list(expense_dict().keys())
+    # Quotes inside a name (בע"מ) would end the phrase, Gmail splits words on them anyway
+    names = ' '.join('"{}"'.format(' '.join(name.replace('"', ' ').split())) for name in suppliers)
+    query = f'has:attachment {{{names}}}'
+    if newer_than:
+        query += f' newer_than:{newer_than}'
+    return query
+
+
+def attachment_parts(payload):
+    """ Yields the parts of a message payload (also nested ones) that are attachments """
+    if payload.get('filename') and payload.get('body', {}).get('attachmentId'):
+        yield payload
+    for part in payload.get('parts', []):
+        yield from attachment_parts(part)
+
+
+def write_base64(data, file):
+    """ Decodes urlsafe base64 text into a binary file in chunks, returns the sha256 of the content """
+    sha256 = hashlib.sha256()
+    data += '=' * (-len(data) % 4)
+    for i in range(0, len(data), DECODE_CHUNK_SIZE):
+        chunk = base64.urlsafe_b64decode(data[i:i + DECODE_CHUNK_SIZE])
+        sha256.update(chunk)
+        file.write(chunk)
+    return sha256.hexdigest()
+
+
+class AttachmentHarvester:
+    """ Fetches attachments into save_path, keeping a manifest of the messages and files already pulled """
+
+    def __init__(self, service, save_path='./attachments', max_workers=DEFAULT_WORKERS):
+        self.service = service
+        self.save_path = save_path
+        self.max_workers = max_workers
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._manifest_file = os.path.join(save_path, MANIFEST_FILE)
+        os.makedirs(save_path, exist_ok=True)
+
+        # messages - ids of messages whose attachments were all pulled, files - {sha256: file name}
+        try:
+            with open(self._manifest_file, encoding='utf-8') as f:
+                self._manifest = json.load(f)
+        except (OSError, ValueError):
+            self._manifest = {'messages': [], 'files': {}}
+        self._done_messages = set(self._manifest['messages'])
+
+    def _http(self):
+        """ Each worker thread gets its own authorized connection (httplib2 is not thread-safe) """
+        if not hasattr(self._local, 'http'):
+            self._local.http = AuthorizedHttp(get_credentials(), http=httplib2.Http())
+        return self._local.http
+
+    def _save_manifest(self):
+        self._manifest['messages'] = sorted(self._done_messages)
+        tmp_file = f'{self._manifest_file}.tmp'
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(self._manifest, f, ensure_ascii=False)
+        os.replace(tmp_file, self._manifest_file)
+
+    def _unique_name(self, file_name, digest):
+        """ Keeps the original name, unless another file already has it """
+        if not os.path.exists(os.path.join(self.save_path, file_name)):
+            return file_name
+        stem, ext = os.path.splitext(file_name)
+        return f'{stem}-{digest[:8]}{ext}'
+
+    def _store(self, msg_id, part):
+        """ Fetches one attachment and stores it, unless a file with the same content exists """
+        attachment = self.service.users().messages().attachments().get(
+            userId='me', messageId=msg_id, id=part['body']['attachmentId']).execute(http=self._http())
+
+        tmp_file = os.path.join(self.save_path, f'.{msg_id}-{part.get("partId", "")}.tmp')
+        with open(tmp_file, 'wb') as f:
+            digest = write_base64(attachment['data'], f)
+        del attachment
+
+        with self._lock:
+            file_name = self._manifest['files'].get(digest)
+            if file_name is not None:
+                os.remove(tmp_file)
+                return {'message_id': msg_id, 'file_name': file_name, 'sha256': digest, 'new': False}
+
+            file_name = self._unique_name(os.path.basename(part['filename']), digest)
+            os.replace(tmp_file, os.path.join(self.save_path, file_name))
+            self._manifest['files'][digest] = file_name
+            return {'message_id': msg_id, 'file_name': file_name, 'sha256': digest, 'new': True}
+
+    def _harvest_message(self, msg_id):
+        try:
+            msg = self.service.users().messages().get(userId='me', id=msg_id).execute(http=self._http())
+            results = [self._store(msg_id, part) for part in attachment_parts(msg['payload'])]
+        except HttpError as error:
+            print(f"An error occurred: {error}")
+            return []
+
+        with self._lock:
+            self._done_messages.add(msg_id)
+        return results
+
+    def harvest(self, query):
+        """
+        Pulls the attachments of the messages matching the query that were not pulled before.
+        Returns records (message_id, file_name, sha256, new) of the attachments fetched in this run.
+        """
+        message_ids = [i for i in list_message_ids(self.service, query) if i not in self._done_messages]
+
+        results = []
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                for records in executor.map(self._harvest_message, message_ids):
+                    results.extend(records)
+        finally:
+            with self._lock:
+                self._save_manifest()
+
+        return results
+
+
+def harvest_attachments(service, query, save_path='./attachments', max_workers=DEFAULT_WORKERS):
+    """ Pulls the new attachments of the messages matching the query into save_path """
+    return AttachmentHarvester(service, save_path, max_workers).harvest(query)
@@ -0,0 +1,59 @@
+"""
+Measures the peak memory (RSS) of merging synthetic documents in memory and on disk.
+
+Every measurement runs in a fresh process, so the peaks don't mix.
+Run from the project root:  python -m benchmarks.merge_memory
+"""
+
+import os
+import sys
+import resource
+import subprocess
+from io import BytesIO
+
+import pymupdf
+
+from pdf_tools import merge_pdfs, merge_pdf_files
+
+
+def synthetic_document(index):
+    """ A one page pdf with some text and a noisy image (~70KB), like a scanned bill """
+    pdf = pymupdf.open()
+    page = pdf.new_page()
+    page.insert_text((72, 72), f'Bill no. {index}')
+    # Random pixels don't compress, so every document keeps its size
+    pixmap = pymupdf.Pixmap(pymupdf.csRGB, 150, 150, os.urandom(150 * 150 * 3), False)
+    page.insert_image(pymupdf.Rect(72, 100, 372, 400), pixmap=pixmap)
+    return pdf.tobytes()
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run(mode, n_documents):
+    documents = (synthetic_document(i) for i in range(n_documents))
+    if mode == 'disk':
+        output = merge_pdf_files(BytesIO(d) for d in documents)
+    else:
+        output = merge_pdfs(documents)
+    output.close()
+    print(f'{peak_rss_mb():.1f}')
+
+
+def main():
+    for n_documents in (50, 200, 800):
+        peaks = {}
+        for mode in ('memory', 'disk'):
+            result = subprocess.run([sys.executable, '-m', 'benchmarks.merge_memory', mode, str(n_documents)],
+                                    capture_output=True, text=True, check=True)
+            peaks[mode] = result.stdout.strip()
+        print(f"{n_documents:>4} docs: memory {peaks['memory']} MB, disk {peaks['disk']} MB peak RSS")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 3:
+        run(sys.argv[1], int(sys.argv[2]))
+    else:
+        main()
@@ -0,0 +1,55 @@
+"""
+Benchmark of the receipt / invoice pairing on synthetic reporting periods.
+
+Run from the project root:  python -m benchmarks.pairing
+"""
+
+import random
+import time
+
+from income_pairing import pair_documents, RECEIPT, INVOICE
+
+
+def synthetic_period(n_documents, seed=0):
+    """
+    Returns n_documents income docs: invoices, receipts referring to them (some to invoices
+    of an earlier period) and a few invoices without receipts, in shuffled order.
+    """
+    rng = random.Random(seed)
+    items = []
+    number = 10000
+    while len(items) < n_documents:
+        number += 1
+        invoice = {'type': INVOICE, 'number': str(number), 'url': {'he': f'https://docs/{number}'}}
+        receipt = {'type': RECEIPT, 'number': str(number + 500000),
+                   'remarks': f'Payment for invoice no. {number}',
+                   'url': {'he': f'https://docs/r{number}'}}
+        r = rng.random()
+        if r < 0.05:
+            items.append(invoice)  # not paid yet
+        elif r < 0.10:
+            items.append(receipt)  # invoice from an earlier period
+        else:
+            items.extend([invoice, receipt])
+    rng.shuffle(items)
+    return items[:n_documents]
+
+
+def main():
+    earlier = {}
+
+    def lookup(number):
+        return earlier.setdefault(number, {'type': INVOICE, 'number': number})
+
+    for n in (1000, 10000, 100000):
+        items = synthetic_period(n)
+        start = time.perf_counter()
+        result = pair_documents(items, lookup)
+        elapsed = time.perf_counter() - start
+        print(f'{n:>7} docs: {elapsed * 1000:8.1f} ms, {len(result.documents)} ordered, '
+              f'{len(result.unmatched_receipts)} unmatched receipts, '
+              f'{len(result.unmatched_invoices)} unmatched invoices')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+"""
+This file holds the local Google Calendar event cache (SQLite).
+
+The cache is filled once by a full sync and then updated incrementally with the
+calendar's syncToken, so upcoming-event and date-range queries run locally.
+"""
+
+import os
+import json
+import time
+import sqlite3
+import datetime
+import threading
+from googleapiclient.errors import HttpError
+
+
+DEFAULT_CALENDAR_FILE = '.cache/calendar.sqlite3'
+# Events per page when listing events
+PAGE_SIZE = 2500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    id TEXT PRIMARY KEY,
+    summary TEXT,
+    start TEXT,
+    end TEXT,
+    start_utc TEXT,
+    end_utc TEXT,
+    event TEXT
+);
+CREATE INDEX IF NOT EXISTS events_start_utc ON events (start_utc);
+CREATE TABLE IF NOT EXISTS state (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+def to_utc(value):
+    """
+    Turns an event time ({'dateTime': ...} or {'date': ...} for all-day events) or a
+    date / datetime / ISO string into a sortable naive UTC ISO string
+    """
+    if isinstance(value, dict):
+        value = value.get('dateTime', value.get('date'))
+    if isinstance(value, str):
+        value = datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if not isinstance(value, datetime.datetime):
+        value = datetime.datetime(value.year, value.month, value.day)
+    if value.tzinfo is not None:
+        value = value.astimezone(datetime.UTC).replace(tzinfo=None)
+    return value.isoformat(timespec='seconds')
+
+
+class CalendarCache:
+    """ Local cache of the events of one calendar, synced incrementally by syncToken """
+
+    def __init__(self, path=DEFAULT_CALENDAR_FILE, calendar_id='primary'):
+        self.path = path
+        self.calendar_id = calendar_id
+        self._sync_lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with self._connect() as db:
+            db.executescript(SCHEMA)
+
+    def _connect(self):
+        db = sqlite3.connect(self.path)
+        db.row_factory = sqlite3.Row
+        return db
+
+    def _state(self, db, key):
+        row = db.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        return row['value'] if row else None
+
+    def _apply(self, db, events):
+        for event in events:
+            if event.get('status') == 'cancelled':
+                db.execute("DELETE FROM events WHERE id = ?", (event['id'],))
+                continue
+            db.execute("INSERT OR REPLACE INTO events (id, summary, start, end, start_utc, end_utc, event) "
+                       "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                       (event['id'], event.get('summary'),
+                        event['start'].get('dateTime', event['start'].get('date')),
+                        event['end'].get('dateTime', event['end'].get('date')),
+                        to_utc(event['start']), to_utc(event['end']),
+                        json.dumps(event, ensure_ascii=False)))
+
+    def _list_changes(self, service, sync_token=None):
+        """ Lists all event pages (all events, or the changes since sync_token), returns (events, next sync token) """
+        events = []
+        page_token = None
+        while True:
+            results = service.events().list(calendarId=self.calendar_id, singleEvents=True,
+                                            maxResults=PAGE_SIZE, syncToken=sync_token,
+                                            pageToken=page_token).execute()
+            events.extend(results.get('items', []))
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                return events, results.get('nextSyncToken')
+
+    def _save(self, events, sync_token, full):
+        with self._connect() as db:
+            if full:
+                db.execute("DELETE FROM events")
+            self._apply(db, events)
+            db.execute("INSERT OR REPLACE INTO state (key, value) VALUES ('sync_token', ?)", (sync_token,))
+            db.execute("INSERT OR REPLACE INTO state (key, value) VALUES ('synced_at', ?)", (str(time.time()),))
+
+    def full_sync(self, service):
+        """ Rebuilds the cache from all the events of the calendar """
+        events, sync_token = self._list_changes(service)
+        self._save(events, sync_token, full=True)
+
+    def sync(self, service, max_age=0):
+        """
+        Brings the cache up to date. Skipped if the last sync is less than max_age seconds old.
+        If Google invalidated the sync token (410 Gone), the cache is rebuilt with a full sync.
+        """
+        with self._sync_lock:
+            with self._connect() as db:
+                sync_token = self._state(db, 'sync_token')
+                synced_at = float(self._state(db, 'synced_at') or 0)
+
+            if sync_token is not None and time.time() - synced_at < max_age:
+                return
+
+            if sync_token is None:
+                self.full_sync(service)
+                return
+
+            try:
+                events, next_sync_token = self._list_changes(service, sync_token)
+                self._save(events, next_sync_token, full=False)
+            except HttpError as error:
+                if error.resp.status != 410:
+                    raise
+                self.full_sync(service)
+
+    def _query(self, where, params, limit=None):
+        sql = f"SELECT event FROM events WHERE {where} ORDER BY start_utc"
+        if limit is not None:
+            sql += f" LIMIT {int(limit)}"
+        with self._connect() as db:
+            return [json.loads(row['event']) for row in db.execute(sql, params)]
+
+    def upcoming(self, max_results=5, now=None):
+        """ Events that haven't ended yet, sorted by start time """
+        now = to_utc(now or datetime.datetime.now(datetime.UTC))
+        return self._query("end_utc > ?", (now,), max_results)
+
+    def between(self, start, end):
+        """ Events overlapping the range start - end (dates, datetimes or ISO strings), sorted by start time """
+        return self._query("start_utc < ? AND end_utc > ?", (to_utc(end), to_utc(start)))
@@ -0,0 +1,91 @@
+"""
+Checks send_email_with_buffers_attachments end to end against a fake Gmail upload endpoint.
+
+The Gmail service is built with a fake http object that answers the resumable upload handshake
+(200 with a session location, 308 with the received range per chunk, 200 with the sent message),
+and the uploaded RFC 822 message is decoded and compared with the original attachments.
+The small-message ('raw') path is checked the same way.
+Run from the project root:  python -m checks.resumable_send
+"""
+
+import os
+import re
+import json
+import base64
+import email
+from email import policy
+from io import BytesIO
+
+import httplib2
+from googleapiclient.discovery import build_from_document
+
+from google_services import (discovery_document, send_email_with_buffers_attachments, UPLOAD_CHUNK_SIZE,
+                             RESUMABLE_UPLOAD_THRESHOLD)
+
+
+UPLOAD_SESSION = 'https://upload.fake/session/1'
+
+
+class FakeGmailHttp:
+    """ Records what is sent to messages.send, through the 'raw' body or the resumable upload """
+
+    def __init__(self):
+        self.uploaded = BytesIO()
+        self.raw = None
+        self.chunks = 0
+
+    def request(self, uri, method='GET', body=None, headers=None, redirections=None, connection_type=None):
+        headers = {name.lower(): value for name, value in (headers or {}).items()}
+        if uri == UPLOAD_SESSION:
+            return self._chunk(body, headers)
+        if 'uploadType=resumable' in uri:
+            return httplib2.Response({'status': 200, 'location': UPLOAD_SESSION}), b''
+        self.raw = json.loads(body)['raw']
+        return httplib2.Response({'status': 200}), b'{"id": "raw-1"}'
+
+    def _chunk(self, body, headers):
+        # Content-Range: bytes <first>-<last>/<total>, the total is '*' until the last chunk
+        first, last, total = re.match(r'bytes (\d+)-(\d+)/(\d+|\*)', headers['content-range']).groups()
+        assert int(first) == self.uploaded.tell(), 'chunk does not continue the upload'
+        self.uploaded.write(body if isinstance(body, bytes) else body.read())
+        self.chunks += 1
+        if total != '*' and int(last) + 1 == int(total):
+            return httplib2.Response({'status': 200}), b'{"id": "upload-1"}'
+        return httplib2.Response({'status': 308, 'range': f'bytes=0-{last}'}), b''
+
+
+def attachments_of(message_bytes):
+    """ {file name: content} of the attachments of an RFC 822 message """
+    message = email.message_from_bytes(message_bytes, policy=policy.default)
+    return {part.get_filename(): part.get_payload(decode=True) for part in message.iter_attachments()}
+
+
+def send(http, file_buffers, threshold):
+    service = build_from_document(discovery_document('gmail', 'v1'), http=http)
+    return send_email_with_buffers_attachments(service, 'me@example.com', 'to@example.com', 'cc@example.com',
+                                               'Report', 'Body', file_buffers, resumable_threshold=threshold)
+
+
+def main():
+    # Big enough for several upload chunks and above the resumable threshold
+    attachments = {'income.pdf': os.urandom(UPLOAD_CHUNK_SIZE + 12345),
+                   'expenses.pdf': os.urandom(RESUMABLE_UPLOAD_THRESHOLD)}
+
+    http = FakeGmailHttp()
+    sent = send(http, [(name, BytesIO(content)) for name, content in attachments.items()],
+                RESUMABLE_UPLOAD_THRESHOLD)
+    assert sent == {'id': 'upload-1'}, sent
+    assert http.raw is None, 'a big message was sent raw'
+    assert attachments_of(http.uploaded.getvalue()) == attachments, 'uploaded attachments differ'
+    print(f'resumable upload: {http.uploaded.tell() / 1024 / 1024:.1f}MB in {http.chunks} chunks, OK')
+
+    small = {'note.pdf': b'%PDF-1.4 small'}
+    http = FakeGmailHttp()
+    sent = send(http, [(name, BytesIO(content)) for name, content in small.items()], RESUMABLE_UPLOAD_THRESHOLD)
+    assert sent == {'id': 'raw-1'}, sent
+    assert attachments_of(base64.urlsafe_b64decode(http.raw)) == small, 'raw attachments differ'
+    print('raw send: OK')
+
+
+if __name__ == '__main__':
+    main()
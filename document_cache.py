@@ -0,0 +1,191 @@
+"""
+This file holds the local on-disk cache of downloaded morning documents.
+
+Document files are stored content-addressed (by sha256), and an index maps each morning
+document id to its file. The cache is bounded in size, the least recently used documents
+are evicted first.
+"""
+
+import os
+import json
+import time
+import hashlib
+import uuid
+import threading
+from io import BytesIO
+from urllib.parse import urlsplit
+from dotenv import load_dotenv
+
+
+DEFAULT_CACHE_DIR = '.cache/documents'
+DEFAULT_MAX_BYTES = 500 * 1024 * 1024
+COPY_CHUNK_SIZE = 64 * 1024
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def _url_version(url):
+    """ The part of the url that identifies the document file (query strings may be signatures) """
+    parts = urlsplit(url)
+    return f'{parts.netloc}{parts.path}'
+
+
+class DocumentCache:
+    """ Size-bounded LRU cache of document files, keyed by morning document id and content hash """
+
+    def __init__(self, path=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._blobs = os.path.join(path, 'blobs')
+        self._index_file = os.path.join(path, 'index.json')
+        self._lock = threading.Lock()
+        self._dirty = False
+        os.makedirs(self._blobs, exist_ok=True)
+
+        # doc_id -> {'hash', 'size', 'version', 'accessed'}
+        try:
+            with open(self._index_file, encoding='utf-8') as f:
+                self._index = json.load(f)
+        except (OSError, ValueError):
+            self._index = {}
+
+    def _blob_path(self, digest):
+        return os.path.join(self._blobs, f'{digest}.pdf')
+
+    def _total_bytes(self):
+        # Several documents may share one file, count every file once
+        sizes = {entry['hash']: entry['size'] for entry in self._index.values()}
+        return sum(sizes.values())
+
+    def _save_index(self):
+        tmp_file = f'{self._index_file}.tmp'
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(self._index, f)
+        os.replace(tmp_file, self._index_file)
+        self._dirty = False
+
+    def _remove(self, doc_id):
+        entry = self._index.pop(doc_id)
+        if not any(e['hash'] == entry['hash'] for e in self._index.values()):
+            try:
+                os.remove(self._blob_path(entry['hash']))
+            except FileNotFoundError:
+                pass
+
+    def _evict(self):
+        """ Removes least recently used documents until the cache fits in max_bytes """
+        total = self._total_bytes()
+        for doc_id in sorted(self._index, key=lambda k: self._index[k]['accessed']):
+            if total <= self.max_bytes:
+                break
+            entry = self._index[doc_id]
+            self._remove(doc_id)
+            if not any(e['hash'] == entry['hash'] for e in self._index.values()):
+                total -= entry['size']
+
+    def path_for(self, doc_id, url):
+        """ Returns the path of the cached file of the document, or None if it is not cached """
+        with self._lock:
+            entry = self._index.get(doc_id)
+            if entry is None:
+                return None
+            # The document file was replaced in morning
+            if entry['version'] != _url_version(url):
+                self._remove(doc_id)
+                self._dirty = True
+                return None
+            blob_path = self._blob_path(entry['hash'])
+            if not os.path.exists(blob_path):
+                self._index.pop(doc_id)
+                self._dirty = True
+                return None
+            entry['accessed'] = time.time()
+            self._dirty = True
+            return blob_path
+
+    def get(self, doc_id, url):
+        """ Returns the cached content of the document, or None if it is not cached """
+        blob_path = self.path_for(doc_id, url)
+        if blob_path is None:
+            return None
+        try:
+            with open(blob_path, 'rb') as f:
+                content = f.read()
+        except FileNotFoundError:
+            # evicted by another thread in the meantime
+            return None
+        # Drop files that were corrupted on disk
+        if hashlib.sha256(content).hexdigest() != os.path.basename(blob_path)[:-len('.pdf')]:
+            self.invalidate(doc_id)
+            return None
+        return content
+
+    def put(self, doc_id, url, content):
+        """ Stores the content of the document and evicts old documents if the cache is too big """
+        self.put_file(doc_id, url, BytesIO(content))
+
+    def put_file(self, doc_id, url, file):
+        """ Like put, but copies the document from an open binary file in chunks """
+        # Copy to a temp file while hashing, then move it to its content address
+        tmp_file = os.path.join(self._blobs, f'{uuid.uuid4().hex}.tmp')
+        sha256 = hashlib.sha256()
+        size = 0
+        with open(tmp_file, 'wb') as f:
+            for chunk in iter(lambda: file.read(COPY_CHUNK_SIZE), b''):
+                sha256.update(chunk)
+                f.write(chunk)
+                size += len(chunk)
+
+        digest = sha256.hexdigest()
+        with self._lock:
+            os.replace(tmp_file, self._blob_path(digest))
+            self._index[doc_id] = {
+                'hash': digest,
+                'size': size,
+                'version': _url_version(url),
+                'accessed': time.time(),
+            }
+            self._evict()
+            self._save_index()
+
+    def open(self, doc_id, url):
+        """ Returns the cached document as an open binary file, or None if it is not cached """
+        blob_path = self.path_for(doc_id, url)
+        if blob_path is None:
+            return None
+        try:
+            return open(blob_path, 'rb')
+        except FileNotFoundError:
+            # evicted by another thread in the meantime
+            return None
+
+    def invalidate(self, doc_id):
+        """ Removes the document from the cache """
+        with self._lock:
+            if doc_id in self._index:
+                self._remove(doc_id)
+                self._save_index()
+
+    def flush(self):
+        """ Saves the access times of the documents read since the last save """
+        with self._lock:
+            if self._dirty:
+                self._save_index()
+
+
+def get_document_cache():
+    """
+    Returns the process-wide document cache, configured by the DOCUMENT_CACHE_DIR and
+    DOCUMENT_CACHE_MAX_BYTES env variables. Returns None if the cache is disabled
+    (DOCUMENT_CACHE_MAX_BYTES=0).
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            load_dotenv()
+            max_bytes = int(os.getenv('DOCUMENT_CACHE_MAX_BYTES', DEFAULT_MAX_BYTES))
+            if max_bytes <= 0:
+                return None
+            _cache = DocumentCache(os.getenv('DOCUMENT_CACHE_DIR', DEFAULT_CACHE_DIR), max_bytes)
+        return _cache
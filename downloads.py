@@ -0,0 +1,212 @@
+"""
+This file holds the concurrent downloader for morning documents.
+"""
+
+import os
+import time
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from dotenv import load_dotenv
+
+from morning_client import get_client
+from document_cache import get_document_cache
+
+
+# Defaults, can be overridden with the DOWNLOAD_WORKERS / DOWNLOAD_TIMEOUT env variables
+DEFAULT_WORKERS = 8
+DEFAULT_TIMEOUT = 30  # seconds, per request
+# A download still running after this many seconds gets a duplicate request
+DEFAULT_HEDGE_AFTER = 5
+# Overall time (seconds) a report may spend on downloads
+DEFAULT_REPORT_DEADLINE = 300
+# Downloads to file are kept in memory up to this size, larger ones go to disk
+SPOOL_MAX_SIZE = 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+# Default of iter_downloads' cache: the process-wide document cache (None turns caching off)
+PROCESS_CACHE = object()
+
+
+class MissingDocumentsError(Exception):
+    """ Some documents could not be downloaded (failed, or not in time), so a pdf would be incomplete """
+
+    def __init__(self, missing):
+        super().__init__(f"{len(missing)} documents still missing: {', '.join(str(d) for d, _ in missing)}")
+        self.missing = missing  # [(doc_id, url)]
+
+
+def hedge_settings():
+    """
+    Returns (hedge_after, report_deadline) in seconds, from the DOWNLOAD_HEDGE_AFTER / REPORT_DEADLINE
+    env variables
+    """
+    load_dotenv()
+    hedge_after = float(os.getenv('DOWNLOAD_HEDGE_AFTER', DEFAULT_HEDGE_AFTER))
+    report_deadline = float(os.getenv('REPORT_DEADLINE', DEFAULT_REPORT_DEADLINE))
+    return hedge_after, report_deadline
+
+
+def download_settings(max_workers=None, timeout=None):
+    """ Returns (max_workers, timeout), filling missing values from the env or the defaults """
+    load_dotenv()
+    if max_workers is None:
+        max_workers = int(os.getenv('DOWNLOAD_WORKERS', DEFAULT_WORKERS))
+    if timeout is None:
+        timeout = float(os.getenv('DOWNLOAD_TIMEOUT', DEFAULT_TIMEOUT))
+    return max(1, max_workers), timeout
+
+
+def download(url, timeout=None, client=None):
+    """ Downloads one document, returns its content or None if the download was not successful """
+    _, timeout = download_settings(timeout=timeout)
+    client = client or get_client()
+    response = client.get(url, timeout=timeout)
+    if response.status_code == 200:
+        return response.content
+    return None
+
+
+def download_to_file(url, timeout=None, client=None):
+    """
+    Downloads one document in chunks into a spooled temp file (kept in memory while small,
+    moved to disk when it grows). Returns the file at position 0, or None if the download
+    was not successful.
+    """
+    _, timeout = download_settings(timeout=timeout)
+    client = client or get_client()
+    with client.get(url, timeout=timeout, stream=True) as response:
+        if response.status_code != 200:
+            return None
+        file = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+            file.write(chunk)
+    file.seek(0)
+    return file
+
+
+def fetch_document(doc_id, url, timeout=None, client=None, cache=None):
+    """
+    Returns the content of a morning document, from the document cache if it is there,
+    otherwise downloads it and stores it in the cache.
+    """
+    if cache is not None and doc_id is not None:
+        content = cache.get(doc_id, url)
+        if content is not None:
+            return content
+
+    content = download(url, timeout, client)
+
+    if content is not None and cache is not None and doc_id is not None:
+        cache.put(doc_id, url, content)
+    return content
+
+
+def fetch_document_file(doc_id, url, timeout=None, client=None, cache=None):
+    """ Like fetch_document, but returns the document as an open binary file (or None) """
+    if cache is not None and doc_id is not None:
+        file = cache.open(doc_id, url)
+        if file is not None:
+            return file
+
+    file = download_to_file(url, timeout, client)
+
+    if file is not None and cache is not None and doc_id is not None:
+        cache.put_file(doc_id, url, file)
+        file.seek(0)
+    return file
+
+
+def _close(future):
+    """ Closes the file of a losing hedged download """
+    if not future.cancelled() and future.exception() is None and hasattr(future.result(), 'close'):
+        future.result().close()
+
+
+def fetch_hedged(fetch, doc_id, url, timeout, client, cache, hedge_executor, hedge_after, deadline):
+    """
+    Runs fetch on hedge_executor. If it hasn't finished after hedge_after seconds, a duplicate
+    request is sent and the first successful result wins. Returns None if neither succeeded
+    before the deadline (time.monotonic() value).
+    """
+    attempts = [hedge_executor.submit(fetch, doc_id, url, timeout, client, cache)]
+    wait(attempts, timeout=max(0, min(hedge_after, deadline - time.monotonic())))
+    if not attempts[0].done() and time.monotonic() < deadline:
+        attempts.append(hedge_executor.submit(fetch, doc_id, url, timeout, client, cache))
+
+    result = None
+    pending = set(attempts)
+    while pending and result is None:
+        done, pending = wait(pending, timeout=max(0, deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+        if not done:
+            break  # deadline passed
+        for future in done:
+            if result is None and future.exception() is None:
+                result = future.result()
+            else:
+                _close(future)
+
+    # The slower attempts are not needed anymore
+    for future in pending:
+        if not future.cancel():
+            future.add_done_callback(_close)
+    return result
+
+
+def iter_downloads(documents, max_workers=None, timeout=None, client=None, cache=PROCESS_CACHE, to_files=False,
+                   deadline=None, missing=None):
+    """
+    Fetches documents concurrently through the morning client (pooled connections, retries,
+    rate limit) and yields (doc_id, content) in the order of documents.
+
+    documents is an iterable of (doc_id, url). Documents found in the document cache
+    (by default the process-wide cache, cache=None downloads everything) are not downloaded again.
+    At most max_workers documents are fetched at the same time, and only a bounded window of
+    downloads is kept ahead of the caller, so results can be consumed as they arrive.
+    A download still running after DOWNLOAD_HEDGE_AFTER seconds gets a duplicate (hedged) request,
+    and nothing is waited for after the deadline (time.monotonic() value, by default
+    REPORT_DEADLINE seconds from now).
+    content is None for documents that could not be fetched, they are also appended as
+    (doc_id, url) to the missing list if one is given. With to_files, content is an open binary
+    file instead of bytes, which the caller has to close.
+    """
+    max_workers, timeout = download_settings(max_workers, timeout)
+    hedge_after, report_deadline = hedge_settings()
+    if deadline is None:
+        deadline = time.monotonic() + report_deadline
+    client = client or get_client()
+    if cache is PROCESS_CACHE:
+        cache = get_document_cache()
+    fetch = fetch_document_file if to_files else fetch_document
+    documents = iter(documents)
+    window = max_workers * 2
+
+    # Downloads (incl. hedged duplicates) run on hedge_executor, executor runs one coordinator per document
+    hedge_executor = ThreadPoolExecutor(max_workers=max_workers * 2)
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pending = deque()
+
+            def submit_next():
+                document = next(documents, None)
+                if document is not None:
+                    doc_id, url = document
+                    future = executor.submit(fetch_hedged, fetch, doc_id, url, timeout, client, cache,
+                                             hedge_executor, hedge_after, deadline)
+                    pending.append((doc_id, url, future))
+
+            for _ in range(window):
+                submit_next()
+
+            while pending:
+                doc_id, url, future = pending.popleft()
+                content = future.result()
+                if content is None and missing is not None:
+                    missing.append((doc_id, url))
+                submit_next()
+                yield doc_id, content
+    finally:
+        # Don't wait for downloads that are still running after the deadline
+        hedge_executor.shutdown(wait=False, cancel_futures=True)
+
+    if cache is not None:
+        cache.flush()
@@ -1,32 +1,79 @@
 import os
-import requests
+import threading
 import json
 from dotenv import load_dotenv
-from datetime import datetime
+from datetime import datetime, timedelta
 import calendar
-import pymupdf
-from io import BytesIO
-from collections import defaultdict
+from collections import defaultdict, Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from morning_client import get_client
+from downloads import iter_downloads, MissingDocumentsError
+from income_index import IncomeIndex
+from ledger import Ledger
+from income_pairing import pair_documents
+from analytics import documents_frame, non_docs_totals
+from reconciliation import reconcile_expenses, reconcile_counts, supplier_name
+from pdf_tools import merge_pdfs, merge_pdf_files, merge_to_disk, optimize_pdf, optimize_settings
+
+
+# Number of documents per page when walking morning search results
+SEARCH_PAGE_SIZE = 100
 
 
 def get_token():
-    """ Getting a JWT token"""
-    load_dotenv()
-    token_url = os.getenv('TOKEN_URL')
-    morning_api_key = os.getenv('MORNING_API_KEY')
-    morning_secret = os.getenv('MORNING_SECRET')
+    """ Getting a JWT token (cached until shortly before it expires) """
+    return get_client().token()
 
-    data = {
-        "id": morning_api_key,
-        "secret": morning_secret
-    }
-    values = json.dumps(data, indent=4)  # Pretty-print JSON
-    headers = {
-          'Content-Type': 'application/json'
-        }
-    response = requests.post(url=token_url, data=values, headers=headers)
 
-    return response.json()['token']
+def authorized_post(url, data=None):
+    """
+    POST to a morning endpoint with the cached JWT token.
+    If morning answers 401 the token is refreshed and the request is retried once.
+    """
+    return get_client().post(url, data)
+
+
+def search_page(url, from_date=None, to_date=None, page=1, page_size=SEARCH_PAGE_SIZE):
+    """
+    Gets one page of a morning search endpoint, dates are optional ('YYYY-MM-DD').
+    Error answers raise - they must never be read as an empty page.
+    """
+    body = {'page': page, 'pageSize': page_size}
+    if from_date is not None:
+        body['fromDate'] = from_date
+    if to_date is not None:
+        body['toDate'] = to_date
+
+    response = authorized_post(url, data=json.dumps(body))
+    response.raise_for_status()
+    data = response.json()
+    if 'items' not in data:
+        raise ValueError(f'Morning search answered without items: {data}')
+    return data
+
+
+def iter_search(url, from_date=None, to_date=None, page_size=SEARCH_PAGE_SIZE):
+    """
+    Walks all the pages of a morning search endpoint and yields the items one by one.
+    The next page is fetched in the background while the caller processes the current one.
+    """
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        page = 1
+        future = executor.submit(search_page, url, from_date, to_date, page, page_size)
+
+        while future is not None:
+            data = future.result()
+            items = data['items']
+
+            # Use morning's page count when it is given, otherwise stop at the first partial page
+            pages = data.get('pages')
+            more_pages = page < pages if pages is not None else len(items) == page_size
+
+            page += 1
+            future = executor.submit(search_page, url, from_date, to_date, page, page_size) if more_pages else None
+
+            yield from items
 
 
 def report_period(date=None):
@@ -81,64 +128,179 @@ def report_period(date=None):
     return start_date.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d")
 
 
-def get_incomes(date=None, all_records=False):
-    """ This function gets all the incomes for the upcoming / present reporting period """
+def period_of(date):
+    """
+    Returns the two-month reporting period ('YYYY-MM-DD', 'YYYY-MM-DD') that a document
+    dated date ('YYYY-MM-DD') belongs to. Unlike report_period, there is no shift to the
+    previous period at the beginning of a period.
+    """
+    date = datetime.strptime(date[:10], '%Y-%m-%d')
+    start_month = ((date.month - 1) // 2) * 2 + 1  # 1, 3, 5, 7, 9, 11
+    end_month = start_month + 1
+    last_day_of_end_month = calendar.monthrange(date.year, end_month)[1]
+
+    start_date = datetime(date.year, start_month, 1)
+    end_date = datetime(date.year, end_month, last_day_of_end_month)
+
+    return start_date.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d")
+
+
+def periods_between(from_date, to_date):
+    """ Returns the reporting periods that overlap the range from_date - to_date ('YYYY-MM-DD') """
+    periods = []
+    period = period_of(from_date)
+    while period[0] <= to_date:
+        periods.append(period)
+        next_start = datetime.strptime(period[1], '%Y-%m-%d') + timedelta(days=1)
+        period = period_of(next_start.strftime('%Y-%m-%d'))
+    return periods
+
+
+def iter_incomes(from_date=None, to_date=None):
+    """ Streams the incomes between two dates ('YYYY-MM-DD'), or all incomes if no dates are given """
     load_dotenv()
-    income_url = os.getenv('INCOME_URL')
+    return iter_search(os.getenv('INCOME_URL'), from_date, to_date)
+
 
-    # Getting the JWT token
-    token = get_token()
+def get_incomes(date=None, all_records=False):
+    """ This function gets all the incomes for the upcoming / present reporting period """
+    if all_records:
+        return {'items': list(iter_incomes())}
 
     # Getting upcoming / present reporting period
     fromDate, toDate = report_period(date)
 
-    dates = {
-        'fromDate': fromDate,
-        'toDate': toDate,
-    }
-    # make json string
-    values = json.dumps(dates)
+    return {'items': list(iter_incomes(fromDate, toDate))}
 
-    headers = {
-        'Content-Type': 'application/json',
-        'Authorization': f'Bearer {token}'
-    }
 
-    if all_records:
-        response = requests.post(url=income_url, headers=headers)
-        return response.json()
+def get_incomes_range(from_date=None, to_date=None):
+    """ This function gets the incomes between two dates ('YYYY-MM-DD'), or all incomes if no dates are given """
+    return list(iter_incomes(from_date, to_date))
 
-    else:
-        response = requests.post(url=income_url, data=values, headers=headers)
-        return response.json()
 
+_income_index = None
+_income_index_lock = threading.Lock()
 
-def get_expenses(date=None):
-    """ This function gets all the expenses for the upcoming / present reporting period """
+
+def get_income_index():
+    """ Returns the process-wide index of income documents by number """
+    global _income_index
+    with _income_index_lock:
+        if _income_index is None:
+            _income_index = IncomeIndex(get_incomes_range)
+        return _income_index
+
+
+def iter_expenses(from_date, to_date):
+    """ Streams the expenses between two dates ('YYYY-MM-DD') """
     load_dotenv()
-    expense_url = os.getenv('EXPENSE_URL')
+    return iter_search(os.getenv('EXPENSE_URL'), from_date, to_date)
 
-    # Getting the JWT token
-    token = get_token()
 
+def get_expenses(date=None):
+    """ This function gets all the expenses for the upcoming / present reporting period """
     # Getting upcoming / present reporting period
     fromDate, toDate = report_period(date)
 
-    dates = {
-        'fromDate': fromDate,
-        'toDate': toDate,
-    }
-    # make json string
-    values = json.dumps(dates)
+    return {'items': list(iter_expenses(fromDate, toDate))}
 
-    headers = {
-        'Content-Type': 'application/json',
-        'Authorization': f'Bearer {token}'
-    }
 
-    response = requests.post(url=expense_url, data=values, headers=headers)
+_ledger = None
+_ledger_lock = threading.Lock()
+
+
+def use_ledger():
+    """ True unless the local ledger is turned off with MORNING_LEDGER=0 """
+    load_dotenv()
+    return os.getenv('MORNING_LEDGER', '1') == '1'
+
+
+def get_ledger():
+    """ Returns the process-wide local ledger of morning documents """
+    global _ledger
+    with _ledger_lock:
+        if _ledger is None:
+            def fetch(kind, from_date, to_date):
+                if kind == 'incomes':
+                    return iter_incomes(from_date, to_date)
+                return iter_expenses(from_date, to_date)
+
+            # Periods before the one being reported now are closed
+            _ledger = Ledger(fetch, periods_between, lambda: report_period()[0])
+        return _ledger
 
-    return response.json()
+
+def reopen_ledger():
+    """
+    Makes all the ledger's periods, closed ones too, sync from morning on their next read (e.g. on a
+    manual refresh), so bills added to morning after a period closed show up
+    """
+    if use_ledger():
+        get_ledger().reopen()
+
+
+def morning_items(kind, from_date, to_date):
+    """
+    Returns the docs ('incomes' / 'expenses') of the reporting periods between two dates,
+    from the local ledger (or streamed from morning if the ledger is turned off)
+    """
+    if use_ledger():
+        return get_ledger().period_items(kind, from_date, to_date)
+    if kind == 'incomes':
+        return iter_incomes(from_date, to_date)
+    return iter_expenses(from_date, to_date)
+
+
+def ledger_period_data(kind, date=None):
+    """ The docs of the reporting period of date, in the shape of get_incomes / get_expenses """
+    return {'items': list(morning_items(kind, *report_period(date)))}
+
+
+class PeriodSnapshot:
+    """
+    Request-scoped snapshot of morning data.
+
+    Data is fetched once per (reporting period, document kind) and then shared by every
+    consumer that gets the same snapshot, so all stages of a report see the same documents.
+    Cached data is kept until it is explicitly invalidated.
+    """
+
+    def __init__(self, fetchers=None):
+        # kind -> function(date) returning the morning search response (by default read through the ledger)
+        self._fetchers = fetchers or {
+            'expenses': lambda date=None: ledger_period_data('expenses', date),
+            'incomes': lambda date=None: ledger_period_data('incomes', date),
+        }
+        self._data = {}
+        self._locks = defaultdict(threading.Lock)
+        self._lock = threading.Lock()
+
+    def get(self, kind, date=None):
+        """ Returns the data of the given kind for the reporting period of date """
+        key = (report_period(date), kind)
+        with self._lock:
+            key_lock = self._locks[key]
+
+        # Lock per key, so different periods / kinds can be fetched at the same time
+        with key_lock:
+            if key not in self._data:
+                self._data[key] = self._fetchers[kind](date)
+            return self._data[key]
+
+    def invalidate(self, kind=None, date=None):
+        """
+        Drops cached data. Without arguments everything is dropped, otherwise only
+        the given kind and / or the reporting period of the given date.
+        """
+        period = report_period(date) if date is not None else None
+        with self._lock:
+            for key in list(self._data):
+                key_period, key_kind = key
+                if kind is not None and key_kind != kind:
+                    continue
+                if period is not None and key_period != period:
+                    continue
+                del self._data[key]
 
 
 def expense_dict():
@@ -163,172 +325,126 @@ def expense_dict():
     }
 
 
-def check_number_of_expenses(date=None):
+def period_items(kind, date=None, snapshot=None):
     """
-    This function checks the number of bills for companies in expense_dict
-    and if expected companies have bills
+    Returns the docs ('incomes' / 'expenses') of the reporting period of date.
+    With a snapshot the docs are shared with the other stages, otherwise they are read from the ledger.
     """
-    data = get_expenses(date)
+    if snapshot is not None:
+        return iter(snapshot.get(kind, date)['items'])
 
-    def count_func(company):
-        return sum(1 for d in data['items'] if d.get("supplier", {}).get("name") == company)
+    return iter(morning_items(kind, *report_period(date)))
 
-    shorts = []
-    lacking = []
 
-    if data:
-        # Checking if number of bills is as expected
-        for exp in data['items']:
-            company = exp['supplier']['name']
-            count = count_func(company)
-            expected = 0
-            if company in list(expense_dict().keys()):
-                expected = expense_dict()[company]
+def documents_pdf(documents, progress=None, stage='documents', deadline=None, allow_missing=False):
+    """
+    Downloads the docs (doc_id, url) concurrently (or reads them from the document cache)
+    and merges them into one pdf, in the order of the docs.
+    With PDF_MERGE_TO_DISK=1 the downloads and the merged pdf are kept on disk instead of in memory.
+    With PDF_OPTIMIZE=1 the merged pdf is made smaller (see pdf_tools.optimize_pdf).
+    progress is an optional function(stage, done, total), called as documents arrive
+    ('<stage> documents') and when the merge is finished ('<stage> merge').
+    Slow downloads are hedged and given up at the deadline (see downloads.iter_downloads). Unless
+    allow_missing, MissingDocumentsError is raised instead of returning an incomplete pdf.
+    """
+    if progress is not None:
+        documents = list(documents)
+        total = len(documents)
+        progress(f'{stage} documents', 0, total)
+        progress(f'{stage} merge', 0, 1)
+
+    def contents(results):
+        for done, (_, content) in enumerate(results, 1):
+            if progress is not None:
+                progress(f'{stage} documents', done, total)
+            yield content
+
+    missing = []
+    if merge_to_disk():
+        pdf = merge_pdf_files(contents(iter_downloads(documents, to_files=True, deadline=deadline, missing=missing)))
+    else:
+        pdf = merge_pdfs(contents(iter_downloads(documents, deadline=deadline, missing=missing)))
 
-            if count < expected:
-                shorts.append(f'{company}')
+    if missing and not allow_missing:
+        pdf.close()
+        raise MissingDocumentsError(missing)
 
-        # Checking if all expected companies have bills
-        expected_companies = list(expense_dict().keys())
-        actual_companies = list({d.get("supplier", {}).get("name") for d in data['items']
-                                 if "supplier" in d})
+    # Optional size optimization before the pdf is attached (PDF_OPTIMIZE=1)
+    optimize, image_dpi = optimize_settings()
+    if optimize:
+        pdf = optimize_pdf(pdf, image_dpi)
 
-        for company in expected_companies:
-            if company not in actual_companies:
-                lacking.append(f'{company}')
+    if progress is not None:
+        progress(f'{stage} merge', 1, 1)
 
-    return lacking, shorts
+    return pdf
 
 
-def make_expense_pdf(date=None):
-    """ This function gets all expense docs from morning and merge them into one pdf buffer """
-    data = get_expenses(date)
+def reconcile_period(date=None, snapshot=None):
+    """
+    This function reconciles the bills of the reporting period against expense_dict and
+    returns a Reconciliation with the actual and expected number of bills of each lacking / short supplier
+    """
+    return reconcile_expenses(period_items('expenses', date, snapshot), expense_dict())
+
+
+def reconcile_range(from_date, to_date):
+    """
+    This function fetches the expenses of a whole range (e.g. a year) in one go, splits them
+    into reporting periods and reconciles every period against expense_dict.
+    Returns {(start, end): Reconciliation} for every reporting period in the range.
+    """
+    counts = {period: Counter() for period in periods_between(from_date, to_date)}
+    for item in morning_items('expenses', from_date, to_date):
+        name = supplier_name(item)
+        if name is None or not item.get('date'):
+            continue
+        period = period_of(item['date'])
+        if period in counts:
+            counts[period][name] += 1
+
+    expected = expense_dict()
+    return {period: reconcile_counts(period_counts, expected) for period, period_counts in counts.items()}
 
-    download_urls = [d['url'] for d in data['items'] if 'url' in d]
 
-    # Create an empty PDF
-    expenses_pdf = pymupdf.open()
+def check_number_of_expenses(date=None, snapshot=None):
+    """
+    This function checks the number of bills for companies in expense_dict
+    and if expected companies have bills
+    """
+    reconciliation = reconcile_period(date, snapshot)
 
-    # Download and merge PDFs
-    for url in download_urls:
-        response = requests.get(url)
+    lacking = [b.supplier for b in reconciliation.lacking]
+    shorts = [b.supplier for b in reconciliation.shorts]
 
-        # Ensure successful download
-        if response.status_code == 200:
-            # Load PDF from memory
-            pdf = pymupdf.open("pdf", response.content)
+    return lacking, shorts
 
-            # Append pages to merged PDF
-            expenses_pdf.insert_pdf(pdf)
 
-    # Save combined PDF to memory (BytesIO)
-    expenses_buffer = BytesIO()
-    expenses_pdf.save(expenses_buffer)
-    expenses_buffer.seek(0)
+def make_expense_pdf(date=None, snapshot=None, progress=None, deadline=None):
+    """ This function gets all expense docs from morning and merge them into one pdf buffer """
+    documents = ((d.get('id'), d['url']) for d in period_items('expenses', date, snapshot) if 'url' in d)
 
-    return expenses_buffer
+    return documents_pdf(documents, progress, 'expense', deadline)
 
 
-def make_non_docs_expense_dict(date=None):
+def make_non_docs_expense_dict(date=None, snapshot=None):
     """
     This function gets all expense without docs from morning and sums them by name and
     returns a dict - {name: sum}
     """
-    data = get_expenses(date)
-    # Keep all expenses without doc
-    non_download_urls = [d for d in data['items'] if 'url' not in d]
+    return non_docs_totals(documents_frame(period_items('expenses', date, snapshot)))
 
-    def sum_by_key(data, group_keys, sum_key):
-        grouped_sum = defaultdict(int)
 
-        for item in data:
-            # Navigate through nested keys
-            group_value = item
-            for key in group_keys:
-                group_value = group_value.get(key)
-
-            # Sum the target value
-            grouped_sum[group_value] += item[sum_key]
-
-        return dict(grouped_sum)
-
-    return sum_by_key(non_download_urls, ['supplier', 'name'], 'amount')
-
-
-def make_income_pdf(date=None):
+def make_income_pdf(date=None, snapshot=None, progress=None, deadline=None):
     """ This function gets all income docs from morning and merge them into one pdf buffer """
-    data = get_incomes(date)
-
-    def receipts_list(data_list):
-        """ This function returns a list of receipts numbers, it's index number and associated invoice number """
-        organize_list = []
-        receipts = [d for d in data_list if d['type'] == 400]
-        for r in receipts:  # קבלה
-            associated_doc = (r['remarks'].split(' ')[4])
-            organize_list.append((r['number'], data_list.index(r), associated_doc))
-        return organize_list
-
-    def organize(data_list):
-        """ This function organizes the docs list so that חשבונית comes right after קבלה """
-        organize_list = receipts_list(data_list)
-        for item in organize_list:
-            # Find the dictionary with the given key-value pair
-            dict_to_move = None
-
-            for i, d in enumerate(data_list):
-                # if invoice in same reporting period
-                if d.get('number') == item[2]:
-                    dict_to_move = data_list.pop(i)  # Remove the dict
-                    break
-                # if invoice from previous reporting period
-                else:
-                    all_data = get_incomes(date, True)['items']
-                    if d.get('number') == item[2]:
-                        dict_to_move = all_data.pop(i)  # Remove the dict
-                        break
-
-            if dict_to_move is not None:
-                # Insert the dictionary at the target index
-                data_list.insert(item[1] + 1, dict_to_move)
-
-        return data_list
-
-    def remove_invoice_without_receipt(data_list):
-        """ This function removes invoices that have no receipts """
-        organize_list = receipts_list(data_list)
-        # Keeping only third element (the invoice number)
-        check_list = [x[2] for x in organize_list]
-        for d in data_list:
-            if d['type'] == 305 and d['number'] not in check_list:
-                data_list.pop(data_list.index(d))
-                break
-
-        return data_list
-
-    # Organize the list of docs
-    data_list = organize(data['items'])
-
-    # Remove invoices without receipts
-    data_list = remove_invoice_without_receipt(data_list)
-
-    download_urls = [d['url']['he'] for d in data_list if 'url' in d]
-    # Create an empty PDF
-    incomes_pdf = pymupdf.open()
-    # Download and merge PDFs
-    for url in download_urls:
-        response = requests.get(url)
-        # Ensure successful download
-        if response.status_code == 200:
-            # Load PDF from memory
-            pdf = pymupdf.open("pdf", response.content)
-            # Append pages to merged PDF
-            incomes_pdf.insert_pdf(pdf)
-
-    # Save combined PDF to memory (BytesIO)
-    incomes_buffer = BytesIO()
-    incomes_pdf.save(incomes_buffer)
-    incomes_buffer.seek(0)
-
-    return incomes_buffer
+    # Put every invoice right after its receipt (invoices of earlier periods come from the income index)
+    # and leave out invoices that have no receipts
+    pairing = pair_documents(list(period_items('incomes', date, snapshot)), get_income_index().lookup)
+    data_list = pairing.documents
+
+    if pairing.unmatched_receipts:
+        print(f"Receipts without invoice: {[d.get('number') for d in pairing.unmatched_receipts]}")
 
+    documents = [(d.get('id'), d['url']['he']) for d in data_list if 'url' in d]
 
+    return documents_pdf(documents, progress, 'income', deadline)
@@ -6,7 +6,11 @@ import os.path
 import datetime
 import base64
 import json
-from io import BytesIO
+import uuid
+import tempfile
+import threading
+import time
+import random
 from dotenv import load_dotenv, set_key
 
 import streamlit as st
@@ -14,7 +18,9 @@ import streamlit as st
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+from googleapiclient.http import MediaIoBaseUpload
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.base import MIMEBase
@@ -22,6 +28,40 @@ from email import encoders
 from googleapiclient.errors import HttpError
 
 
+# Define scopes for Gmail and Google Calendar
+SCOPES = [
+    'https://www.googleapis.com/auth/gmail.modify',
+    'https://www.googleapis.com/auth/calendar'
+]
+# Refresh the Google token when it expires within this time
+CREDENTIALS_REFRESH_MARGIN = datetime.timedelta(minutes=5)
+
+# Process-wide cache of the credentials and the discovery documents. The built services are
+# per thread: each one wraps an httplib2.Http, which is not thread-safe
+_credentials = None
+_credentials_lock = threading.Lock()
+_discovery_documents = {}
+_discovery_lock = threading.Lock()
+_local = threading.local()
+
+# Gmail listing: messages per list page, messages per batch request (Gmail advises at most 50)
+LIST_PAGE_SIZE = 500
+BATCH_SIZE = 50
+METADATA_HEADERS = ['Subject', 'From', 'Date']
+
+# Batch sub-requests that fail with a rate limit or server error are retried this many times,
+# with jittered exponential backoff starting at BATCH_RETRY_WAIT seconds
+BATCH_RETRY_ATTEMPTS = 5
+BATCH_RETRY_WAIT = 1
+
+# Messages with attachments from this size (bytes) are sent with the resumable media upload
+RESUMABLE_UPLOAD_THRESHOLD = 4 * 1024 * 1024
+# Upload chunk size, has to be a multiple of 256KB
+UPLOAD_CHUNK_SIZE = 2 * 1024 * 1024
+# Attachments are base64-encoded in chunks of this size (a multiple of 57 bytes = one 76 character line)
+BASE64_CHUNK_SIZE = 57 * 1024
+
+
 def decode_base64(encoded_str):
     """
     Decodes a Base64-encoded string into a Python dictionary.
@@ -31,22 +71,30 @@ def decode_base64(encoded_str):
     return json.loads(decoded_bytes.decode("utf-8"))
 
 
-def activate_services():
-    """
-    Activates Gmail and Google Calendar services.
-    """
-    load_dotenv()
+def _needs_refresh(creds):
+    """ True if the credentials are invalid or expire within CREDENTIALS_REFRESH_MARGIN """
+    if not creds.valid:
+        return True
+    if creds.expiry is None:
+        return False
+    # google-auth keeps expiry as a naive UTC datetime
+    now = datetime.datetime.now(datetime.UTC).replace(tzinfo=None)
+    return creds.expiry - now < CREDENTIALS_REFRESH_MARGIN
+
+
+def _save_token(creds):
+    """ Save updated token to .env """
+    token_b64 = base64.b64encode(creds.to_json().encode()).decode()
+    set_key(".env", "GOOGLE_TOKEN", token_b64)
 
-    # Define scopes for Gmail and Google Calendar
-    SCOPES = [
-        'https://www.googleapis.com/auth/gmail.modify',
-        'https://www.googleapis.com/auth/calendar'
-    ]
+
+def _load_credentials():
+    """ Loads the credentials from the environment, authenticating if there is no usable token """
+    load_dotenv()
     creds = None
 
     # Decode credentials from environment variables (or Streamlit secrets)
     credentials_json = decode_base64(os.getenv("GOOGLE_CREDENTIALS"))
-    token_json = None
 
     # If a token exists, load it
     if "GOOGLE_TOKEN" in os.environ:
@@ -61,78 +109,158 @@ def activate_services():
             flow = InstalledAppFlow.from_client_config(credentials_json, SCOPES)
             creds = flow.run_local_server(port=0)
 
-        # Save updated token to .env
-        token_b64 = base64.b64encode(creds.to_json().encode()).decode()
-        set_key(".env", "GOOGLE_TOKEN", token_b64)
+        _save_token(creds)
 
-    try:
-        # Initialize Gmail service
-        gmail_service = build('gmail', 'v1', credentials=creds)
+    return creds
 
-        # Initialize Google Calendar service
-        calendar_service = build('calendar', 'v3', credentials=creds)
 
-        return gmail_service, calendar_service
+def get_credentials():
+    """
+    Returns the authorized Google credentials, cached for the whole process.
+    The token is refreshed only when it is about to expire.
+    """
+    global _credentials
+    with _credentials_lock:
+        if _credentials is None:
+            _credentials = _load_credentials()
+        elif _needs_refresh(_credentials) and _credentials.refresh_token:
+            _credentials.refresh(Request())
+            _save_token(_credentials)
+        return _credentials
 
-    except HttpError as error:
-        print(f"An error occurred: {error}")
-        return None, None
 
+def discovery_document(name, version):
+    """ The discovery document shipped with the client library, read once per process """
+    with _discovery_lock:
+        if (name, version) not in _discovery_documents:
+            _discovery_documents[name, version] = get_static_doc(name, version)
+        return _discovery_documents[name, version]
 
-######################## GMAIL ##################################
 
+def activate_services():
+    """
+    Activates Gmail and Google Calendar services.
+    The services are built once per thread, each with its own authorized connection, from the
+    cached discovery documents (no discovery requests), and share the cached credentials.
+    """
+    creds = get_credentials()
+
+    services = getattr(_local, 'services', None)
+    if services is None:
+        try:
+            # Initialize Gmail service
+            gmail_service = build_from_document(discovery_document('gmail', 'v1'), credentials=creds)
 
-def get_unread_messages(service):
-    """Retrieve unread messages."""
-    results = service.users().messages().list(userId='me', q="is:unread").execute()
-    messages = results.get('messages', [])
-    print(messages)
+            # Initialize Google Calendar service
+            calendar_service = build_from_document(discovery_document('calendar', 'v3'), credentials=creds)
 
-    if not messages:
-        print("No unread messages found.")
-        return
+            services = _local.services = gmail_service, calendar_service
 
-    for msg in messages:
-        msg_id = msg['id']
-        msg_details = service.users().messages().get(userId='me', id=msg_id, format='full').execute()
+        except HttpError as error:
+            print(f"An error occurred: {error}")
+            return None, None
 
-        # Extract email details
-        headers = msg_details.get("payload", {}).get("headers", [])
-        subject = next((h["value"] for h in headers if h["name"] == "Subject"), "No Subject")
-        sender = next((h["value"] for h in headers if h["name"] == "From"), "Unknown Sender")
+    return services
 
-        print(f"From: {sender}")
-        print(f"Subject: {subject}")
-        print("-" * 50)
 
+######################## GMAIL ##################################
 
-def get_recent_messages(service, max_results=5):
-    """Retrieve the first N read and unread messages from inbox."""
-    results = service.users().messages().list(userId='me', q="in:inbox OR in:Updates",
-                                              maxResults=max_results).execute()
-    messages = results.get('messages', [])
 
-    if not messages:
-        print("No messages found.")
-        return
+def message_record(msg):
+    """ Turns a Gmail message (format 'metadata') into a record with its main headers """
+    headers = msg.get("payload", {}).get("headers", [])
+    labels = msg.get("labelIds", [])
+    return {
+        'id': msg['id'],
+        'thread_id': msg.get('threadId'),
+        'history_id': msg.get('historyId'),
+        'internal_date': int(msg.get('internalDate', 0)),
+        'subject': next((h["value"] for h in headers if h["name"] == "Subject"), "No Subject"),
+        'sender': next((h["value"] for h in headers if h["name"] == "From"), "Unknown Sender"),
+        'date': next((h["value"] for h in headers if h["name"] == "Date"), None),
+        'snippet': msg.get('snippet', ''),
+        'labels': labels,
+        'unread': "UNREAD" in labels,
+    }
+
+
+def list_message_ids(service, query=None, max_results=None):
+    """ Returns the ids of the messages matching the query, paging through the results """
+    ids = []
+    page_token = None
+    while True:
+        page_size = LIST_PAGE_SIZE if max_results is None else min(LIST_PAGE_SIZE, max_results - len(ids))
+        results = service.users().messages().list(userId='me', q=query, maxResults=page_size,
+                                                  pageToken=page_token).execute()
+        ids.extend(msg['id'] for msg in results.get('messages', []))
+
+        page_token = results.get('nextPageToken')
+        if not page_token or (max_results is not None and len(ids) >= max_results):
+            return ids
+
+
+def is_transient_error(error):
+    """ True for Google API errors worth retrying: rate limits (429, 403 rate limit) and server errors """
+    if not isinstance(error, HttpError):
+        return False
+    status = error.resp.status
+    return status == 429 or status >= 500 or (status == 403 and b'ratelimitexceeded' in error.content.lower())
+
+
+def get_messages_metadata(service, message_ids, strict=False):
+    """
+    Fetches the Subject / From / Date headers and labels of the messages with batch requests
+    (BATCH_SIZE messages per HTTP call). Returns the records in the order of message_ids.
 
-    for msg in messages:
-        msg_id = msg['id']
-        msg_details = service.users().messages().get(userId='me', id=msg_id, format='full').execute()
+    Messages that failed with a rate limit or server error are fetched again with backoff.
+    Messages that still could not be fetched are left out, or with strict=True the error is raised
+    (for callers that must not miss a message, like the mailbox index).
+    """
+    records = {}
+    failed = {}
+
+    def callback(request_id, response, exception):
+        if exception is not None:
+            failed[request_id] = exception
+            if not is_transient_error(exception):
+                print(f"An error occurred: {exception}")
+        else:
+            records[request_id] = message_record(response)
 
-        # Extract email details
-        headers = msg_details.get("payload", {}).get("headers", [])
-        subject = next((h["value"] for h in headers if h["name"] == "Subject"), "No Subject")
-        sender = next((h["value"] for h in headers if h["name"] == "From"), "Unknown Sender")
+    pending = list(message_ids)
+    for attempt in range(BATCH_RETRY_ATTEMPTS + 1):
+        failed.clear()
+        for i in range(0, len(pending), BATCH_SIZE):
+            batch = service.new_batch_http_request(callback=callback)
+            for msg_id in pending[i:i + BATCH_SIZE]:
+                batch.add(service.users().messages().get(userId='me', id=msg_id, format='metadata',
+                                                         metadataHeaders=METADATA_HEADERS),
+                          request_id=msg_id)
+            batch.execute()
 
-        # Check if message is unread
-        labels = msg_details.get("labelIds", [])
-        status = "Unread" if "UNREAD" in labels else "Read"
+        pending = [msg_id for msg_id, error in failed.items() if is_transient_error(error)]
+        if not pending or attempt == BATCH_RETRY_ATTEMPTS:
+            break
+        time.sleep(random.uniform(0, BATCH_RETRY_WAIT * 2 ** attempt))
 
-        print(f"Status: {status}")
-        print(f"From: {sender}")
-        print(f"Subject: {subject}")
-        print("-" * 50)
+    for msg_id in pending:
+        print(f"An error occurred: {failed[msg_id]}")
+    if strict and pending:
+        raise failed[pending[0]]
+
+    return [records[msg_id] for msg_id in message_ids if msg_id in records]
+
+
+def get_unread_messages(service, max_results=None):
+    """Retrieve unread messages, as records with their main headers."""
+    message_ids = list_message_ids(service, "is:unread", max_results)
+    return get_messages_metadata(service, message_ids)
+
+
+def get_recent_messages(service, max_results=5):
+    """Retrieve the first N read and unread messages from inbox, as records with their main headers."""
+    message_ids = list_message_ids(service, "in:inbox OR in:Updates", max_results)
+    return get_messages_metadata(service, message_ids)
 
 
 def get_attachments(service, msg_id, save_path='./'):
@@ -249,19 +377,100 @@ def send_email_with_streamlit_attachment(service, sender, to, subject, body, upl
     st.success(f"✅ Email sent! Message ID: {sent_message['id']}")
 
 
-def send_email_with_buffers_attachments(service, sender, to, cc, subject, body, file_buffers):
+def valid_buffers(file_buffers):
+    """ Returns the (file_name, buffer) tuples whose buffer can be read and rewound """
+    buffers = []
+    for file_name, buffer in file_buffers:
+        if not hasattr(buffer, 'read') or not hasattr(buffer, 'seek'):
+            print(f"Invalid buffer for file: {file_name}")
+            continue
+        buffers.append((file_name, buffer))
+    return buffers
+
+
+def buffer_size(buffer):
+    """ Returns the size in bytes of a seekable buffer """
+    buffer.seek(0, os.SEEK_END)
+    size = buffer.tell()
+    buffer.seek(0)
+    return size
+
+
+def write_mime_message(file, sender, to, cc, subject, body, file_buffers):
+    """
+    Writes an RFC 822 message with attachments to a binary file, without keeping the
+    attachments in memory: every buffer is base64-encoded straight into the file in chunks.
+    The message is the same as the one built by MIMEMultipart in the raw send path.
+    """
+    boundary = f'==============={uuid.uuid4().hex}=='
+
+    # Headers and the body part, as generated by the email package
+    message = MIMEMultipart(boundary=boundary)
+    message['to'] = to
+    message['cc'] = cc
+    message['from'] = sender
+    message['subject'] = subject
+    message.attach(MIMEText(body, 'plain'))
+    head = message.as_bytes()
+    closing = f'--{boundary}--'.encode()
+    file.write(head[:head.rindex(closing)])
+
+    for file_name, buffer in file_buffers:
+        # Attachment part headers, the payload is written below
+        mime_part = MIMEBase('application', 'octet-stream')
+        mime_part['Content-Transfer-Encoding'] = 'base64'
+        mime_part.add_header('Content-Disposition', f'attachment; filename="{file_name}"')
+        mime_part.set_payload('')
+
+        file.write(f'--{boundary}\n'.encode())
+        file.write(mime_part.as_bytes())
+
+        # Chunks of a multiple of 57 bytes encode to whole 76 character lines
+        buffer.seek(0)
+        for chunk in iter(lambda: buffer.read(BASE64_CHUNK_SIZE), b''):
+            file.write(base64.encodebytes(chunk))
+        file.write(b'\n')
+
+    file.write(closing + b'\n')
+
+
+def send_email_with_buffers_attachments(service, sender, to, cc, subject, body, file_buffers,
+                                        resumable_threshold=RESUMABLE_UPLOAD_THRESHOLD):
     """
     Send an email with multiple in-memory buffers as attachments using the Gmail API.
 
+    Small messages are sent base64-encoded in the request ('raw'). Messages with attachments
+    larger than resumable_threshold bytes are written to a temp file and streamed to Gmail's
+    resumable media upload in chunks, so the attachments are not copied in memory and the
+    'raw' size limit doesn't apply. checks/resumable_send.py sends both kinds through a fake http
+    object (build_from_document(..., http=...)) and compares the uploaded message with the attachments.
+
     Args:
         service: Authenticated Gmail service instance.
         sender: Email address of the sender.
         to: Email address of the recipient.
         subject: Email subject.
         body: Email body (plain text or HTML).
-        file_buffers: List of tuples (file_name, buffer).
+        file_buffers: List of tuples (file_name, buffer), buffer is a BytesIO or an open binary file.
                       Example: [("file1.pdf", io.BytesIO(b"data")), ...]
+        resumable_threshold: Total attachments size (bytes) from which the resumable upload is used.
     """
+    file_buffers = valid_buffers(file_buffers)
+
+    if sum(buffer_size(buffer) for _, buffer in file_buffers) >= resumable_threshold:
+        with tempfile.TemporaryFile() as message_file:
+            write_mime_message(message_file, sender, to, cc, subject, body, file_buffers)
+            message_file.seek(0)
+
+            media = MediaIoBaseUpload(message_file, mimetype='message/rfc822',
+                                      chunksize=UPLOAD_CHUNK_SIZE, resumable=True)
+            request = service.users().messages().send(userId='me', body={}, media_body=media)
+
+            sent_message = None
+            while sent_message is None:
+                _, sent_message = request.next_chunk()
+
+        return sent_message
 
     # Create the email message
     message = MIMEMultipart()
@@ -273,12 +482,8 @@ def send_email_with_buffers_attachments(service, sender, to, cc, subject, body,
     # Attach the body (plain text or HTML)
     message.attach(MIMEText(body, 'plain'))  # Use 'html' if sending HTML content
 
-    # Attach files from buffers
+    # Attach files from buffers (BytesIO or open binary files)
     for file_name, buffer in file_buffers:
-        if not isinstance(buffer, BytesIO):
-            print(f"Invalid buffer for file: {file_name}")
-            continue
-
         # Move to the start of the buffer
         buffer.seek(0)
 
@@ -298,21 +503,31 @@ def send_email_with_buffers_attachments(service, sender, to, cc, subject, body,
     message_body = {'raw': raw_message}
     sent_message = service.users().messages().send(userId='me', body=message_body).execute()
 
+    return sent_message
+
 
 ######################## Calendar ###############################
 
-def get_upcoming_events(service, max_results=5):
-    """Retrieve upcoming events sorted by start time."""
-    now = datetime.datetime.now(datetime.UTC).isoformat()  # Current time in RFC3339 format
-    events_result = service.events().list(
-        calendarId='primary',
-        timeMin=now,
-        maxResults=max_results,
-        singleEvents=True,
-        orderBy='startTime'
-    ).execute()
-
-    events = events_result.get('items', [])
+def get_upcoming_events(service, max_results=5, cache=None, max_age=60):
+    """
+    Retrieve upcoming events sorted by start time.
+    With a calendar_cache.CalendarCache the events are served from the cache, which is
+    synced incrementally when it is older than max_age seconds.
+    """
+    if cache is not None:
+        cache.sync(service, max_age)
+        events = cache.upcoming(max_results)
+    else:
+        now = datetime.datetime.now(datetime.UTC).isoformat()  # Current time in RFC3339 format
+        events_result = service.events().list(
+            calendarId='primary',
+            timeMin=now,
+            maxResults=max_results,
+            singleEvents=True,
+            orderBy='startTime'
+        ).execute()
+
+        events = events_result.get('items', [])
 
     if not events:
         print("No upcoming events found.")
@@ -0,0 +1,87 @@
+"""
+This file holds the local index of all income documents, by document number.
+
+It is used to find invoices from earlier reporting periods without fetching the whole
+income history from morning again. The index is saved to disk and refreshed incrementally.
+"""
+
+import os
+import json
+import time
+import threading
+from datetime import datetime, timedelta
+
+
+DEFAULT_INDEX_FILE = '.cache/income_index.json'
+# Re-fetch this many days before the last sync, to catch documents dated in the past
+SYNC_OVERLAP_DAYS = 31
+# Don't refresh the index on a missing number more often than this (seconds)
+MIN_REFRESH_INTERVAL = 600
+
+
+class IncomeIndex:
+    """
+    Index of income documents by (type, number).
+
+    fetch(from_date, to_date) returns a list of income documents, both dates are
+    'YYYY-MM-DD' strings or None (None for both means the whole history).
+    """
+
+    def __init__(self, fetch, path=DEFAULT_INDEX_FILE):
+        self._fetch = fetch
+        self.path = path
+        self._lock = threading.Lock()
+        self._refreshed_at = 0.0
+
+        try:
+            with open(path, encoding='utf-8') as f:
+                saved = json.load(f)
+            self._synced = saved['synced']
+            self._documents = saved['documents']
+        except (OSError, ValueError, KeyError):
+            self._synced = None
+            self._documents = {}
+
+    @staticmethod
+    def _key(doc_type, number):
+        return f'{doc_type}:{number}'
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_file = f'{self.path}.tmp'
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump({'synced': self._synced, 'documents': self._documents}, f, ensure_ascii=False)
+        os.replace(tmp_file, self.path)
+
+    def refresh(self):
+        """
+        Adds new documents to the index. The first refresh fetches the whole history,
+        the following ones only the documents since the last sync.
+        """
+        with self._lock:
+            today = datetime.today().strftime('%Y-%m-%d')
+            if self._synced is None:
+                documents = self._fetch(None, None)
+            else:
+                from_date = datetime.strptime(self._synced, '%Y-%m-%d') - timedelta(days=SYNC_OVERLAP_DAYS)
+                documents = self._fetch(from_date.strftime('%Y-%m-%d'), today)
+
+            for d in documents:
+                if 'number' in d:
+                    self._documents[self._key(d.get('type'), d['number'])] = d
+
+            self._synced = today
+            self._refreshed_at = time.time()
+            self._save()
+
+    def lookup(self, number, doc_type=305):
+        """
+        Returns the document with the given number and type (invoice by default), or None.
+        A missing number triggers an incremental refresh, at most once per MIN_REFRESH_INTERVAL.
+        """
+        key = self._key(doc_type, number)
+        document = self._documents.get(key)
+        if document is None and time.time() - self._refreshed_at > MIN_REFRESH_INTERVAL:
+            self.refresh()
+            document = self._documents.get(key)
+        return document
@@ -0,0 +1,71 @@
+"""
+This file holds the pairing of receipts (קבלה) with their invoices (חשבונית) for the income report.
+"""
+
+from collections import namedtuple
+
+
+RECEIPT = 400
+INVOICE = 305
+
+PairingResult = namedtuple('PairingResult', ['documents', 'unmatched_receipts', 'unmatched_invoices'])
+
+
+def associated_invoice(receipt):
+    """ Returns the number of the invoice a receipt refers to (written in its remarks), or None """
+    try:
+        return receipt['remarks'].split(' ')[4]
+    except (KeyError, AttributeError, IndexError):
+        return None
+
+
+def pair_documents(items, lookup=None):
+    """
+    Orders the income docs so that every receipt is directly followed by its invoice, in one pass.
+
+    Args:
+        items: The income docs of the reporting period, in morning's order.
+        lookup: Optional function(number) returning an invoice from an earlier period, or None.
+
+    Returns:
+        PairingResult: documents - the ordered docs, invoices without a receipt are left out.
+                       unmatched_receipts - receipts whose invoice was not found.
+                       unmatched_invoices - invoices of the period without a receipt.
+    """
+    invoices = {}
+    for d in items:
+        if d.get('type') == INVOICE:
+            invoices.setdefault(d.get('number'), d)
+
+    documents = []
+    unmatched_receipts = []
+    placed = set()  # numbers of invoices already placed after a receipt
+
+    for d in items:
+        doc_type = d.get('type')
+        # Invoices are placed after their receipt, or left out if they have none
+        if doc_type == INVOICE:
+            continue
+
+        documents.append(d)
+        if doc_type != RECEIPT:
+            continue
+
+        number = associated_invoice(d)
+        # Several receipts (partial payments) may refer to the same invoice
+        if number in placed:
+            continue
+
+        invoice = invoices.get(number)
+        if invoice is None and lookup is not None and number is not None:
+            invoice = lookup(number)
+
+        if invoice is None:
+            unmatched_receipts.append(d)
+        else:
+            documents.append(invoice)
+            placed.add(number)
+
+    unmatched_invoices = [d for d in items if d.get('type') == INVOICE and d.get('number') not in placed]
+
+    return PairingResult(documents, unmatched_receipts, unmatched_invoices)
@@ -0,0 +1,173 @@
+"""
+This file holds the local ledger of morning documents (SQLite).
+
+Documents are stored per reporting period. Open periods are synced again when their data is
+older than LEDGER_MAX_AGE, and only changed documents are written. Periods that were already
+reported are closed: once synced after closing, they are not fetched from morning again until reopened.
+A failed fetch writes nothing, and a period that came back empty is never closed.
+"""
+
+import os
+import json
+import time
+import sqlite3
+import threading
+from collections import defaultdict
+
+
+DEFAULT_LEDGER_FILE = '.cache/ledger.sqlite3'
+# Seconds the documents of an open period are served before they are synced again
+LEDGER_MAX_AGE = 600
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    kind TEXT,
+    id TEXT,
+    period_start TEXT,
+    position INTEGER,
+    date TEXT,
+    updated TEXT,
+    document TEXT,
+    PRIMARY KEY (kind, id)
+);
+CREATE INDEX IF NOT EXISTS documents_period ON documents (kind, period_start, position);
+CREATE TABLE IF NOT EXISTS periods (
+    kind TEXT,
+    start TEXT,
+    end TEXT,
+    synced_at REAL,
+    closed INTEGER,
+    PRIMARY KEY (kind, start)
+);
+"""
+
+
+def updated_stamp(document):
+    """ Last update of a document as sent by morning, falls back to its content when there is none """
+    for key in ('updatedAt', 'lastUpdateDate', 'updated'):
+        if document.get(key) is not None:
+            return str(document[key])
+    return json.dumps(document, sort_keys=True, ensure_ascii=False)
+
+
+class Ledger:
+    """
+    Local store of morning documents by kind ('incomes' / 'expenses') and reporting period.
+
+    fetch(kind, from_date, to_date) returns the documents of a period from morning,
+    periods(from_date, to_date) the reporting periods of a range and
+    closed_before() the start of the first period that is still open.
+    """
+
+    def __init__(self, fetch, periods, closed_before, path=DEFAULT_LEDGER_FILE, max_age=LEDGER_MAX_AGE):
+        self._fetch = fetch
+        self._periods = periods
+        self._closed_before = closed_before
+        self.path = path
+        self.max_age = max_age
+        self._locks = defaultdict(threading.Lock)
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with self._connect() as db:
+            db.executescript(SCHEMA)
+
+    def _connect(self):
+        db = sqlite3.connect(self.path)
+        db.row_factory = sqlite3.Row
+        return db
+
+    def _period_lock(self, kind, start):
+        with self._lock:
+            return self._locks[(kind, start)]
+
+    def sync_period(self, kind, start, end, documents=None):
+        """
+        Fetches the period from morning (unless its documents are given) and writes the documents that changed.
+        A fetch error is raised before anything is written. An empty period stays open, so it is fetched
+        again after max_age instead of being frozen empty.
+        """
+        if documents is None:
+            documents = list(self._fetch(kind, start, end))
+        closed = end < self._closed_before() and len(documents) > 0
+
+        with self._connect() as db:
+            stored = {row['id']: row['updated'] for row in db.execute(
+                "SELECT id, updated FROM documents WHERE kind = ? AND period_start = ?", (kind, start))}
+
+            ids = set()
+            for position, document in enumerate(documents):
+                doc_id = str(document.get('id', f'{start}:{position}'))
+                ids.add(doc_id)
+                updated = updated_stamp(document)
+                if stored.get(doc_id) == updated:
+                    db.execute("UPDATE documents SET position = ? WHERE kind = ? AND id = ?",
+                               (position, kind, doc_id))
+                    continue
+                db.execute("INSERT OR REPLACE INTO documents (kind, id, period_start, position, date, updated, "
+                           "document) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                           (kind, doc_id, start, position, document.get('date'), updated,
+                            json.dumps(document, ensure_ascii=False)))
+
+            # Documents deleted in morning
+            db.executemany("DELETE FROM documents WHERE kind = ? AND id = ?",
+                           [(kind, doc_id) for doc_id in stored if doc_id not in ids])
+
+            db.execute("INSERT OR REPLACE INTO periods (kind, start, end, synced_at, closed) VALUES (?, ?, ?, ?, ?)",
+                       (kind, start, end, time.time(), int(closed)))
+
+    def _is_current(self, kind, start):
+        with self._connect() as db:
+            row = db.execute("SELECT synced_at, closed FROM periods WHERE kind = ? AND start = ?",
+                             (kind, start)).fetchone()
+        if row is None:
+            return False
+        return bool(row['closed']) or time.time() - row['synced_at'] < self.max_age
+
+    def period_items(self, kind, from_date, to_date):
+        """
+        Returns the documents of the reporting periods of the range, in morning's order.
+        Only the periods that are not current are synced, all of them with one range fetch.
+        """
+        periods = self._periods(from_date, to_date)
+        locks = [self._period_lock(kind, start) for start, _ in periods]
+        for lock in locks:
+            lock.acquire()
+        try:
+            stale = [(start, end) for start, end in periods if not self._is_current(kind, start)]
+            if len(stale) == 1:
+                self.sync_period(kind, *stale[0])
+            elif stale:
+                # One request for the whole span, split into the periods by document date
+                # Fetched in full first, so a failed fetch leaves all the periods as they are
+                documents = list(self._fetch(kind, stale[0][0], stale[-1][1]))
+                by_period = {period: [] for period in stale}
+                for document in documents:
+                    date = (document.get('date') or '')[:10]
+                    for start, end in stale:
+                        if start <= date <= end:
+                            by_period[(start, end)].append(document)
+                            break
+                for (start, end), documents in by_period.items():
+                    self.sync_period(kind, start, end, documents)
+        finally:
+            for lock in locks:
+                lock.release()
+
+        items = []
+        with self._connect() as db:
+            for start, _ in periods:
+                items.extend(json.loads(row['document']) for row in db.execute(
+                    "SELECT document FROM documents WHERE kind = ? AND period_start = ? ORDER BY position",
+                    (kind, start)))
+        return items
+
+    def reopen(self, kind=None):
+        """
+        Marks periods as open again (all kinds by default), e.g. after a correction or a late bill in morning.
+        Each period is synced again on its next read only, and closed again by that sync.
+        """
+        with self._connect() as db:
+            if kind is None:
+                db.execute("UPDATE periods SET closed = 0, synced_at = 0")
+            else:
+                db.execute("UPDATE periods SET closed = 0, synced_at = 0 WHERE kind = ?", (kind,))
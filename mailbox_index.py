@@ -0,0 +1,187 @@
+"""
+This file holds the local Gmail mailbox index (SQLite).
+
+The index is filled once by a full sync and then kept current with users.history.list
+from the last historyId, so unread / recent / search queries run locally.
+"""
+
+import os
+import sqlite3
+import threading
+from googleapiclient.errors import HttpError
+
+from google_services import list_message_ids, get_messages_metadata
+
+
+DEFAULT_MAILBOX_FILE = '.cache/mailbox.sqlite3'
+# Labels of the messages shown as recent (Gmail's "in:inbox OR in:Updates")
+RECENT_LABELS = ('INBOX', 'CATEGORY_UPDATES')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id TEXT PRIMARY KEY,
+    thread_id TEXT,
+    internal_date INTEGER,
+    subject TEXT,
+    sender TEXT,
+    date TEXT,
+    snippet TEXT,
+    unread INTEGER
+);
+CREATE TABLE IF NOT EXISTS message_labels (
+    message_id TEXT,
+    label TEXT,
+    PRIMARY KEY (message_id, label)
+);
+CREATE INDEX IF NOT EXISTS message_labels_label ON message_labels (label);
+CREATE INDEX IF NOT EXISTS messages_internal_date ON messages (internal_date);
+CREATE TABLE IF NOT EXISTS state (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+COLUMNS = ['id', 'thread_id', 'internal_date', 'subject', 'sender', 'date', 'snippet', 'unread']
+# Messages with these labels are not indexed, like Gmail's listing without includeSpamTrash
+EXCLUDED_LABELS = {'TRASH', 'SPAM'}
+
+
+class MailboxIndex:
+    """ Local index of Gmail messages, synced incrementally by historyId """
+
+    def __init__(self, path=DEFAULT_MAILBOX_FILE, full_sync_query=None):
+        """
+        Args:
+            path: The SQLite file of the index.
+            full_sync_query: Optional Gmail query limiting the full sync (e.g. 'newer_than:1y'),
+                             new messages are always added by the incremental sync.
+        """
+        self.path = path
+        self.full_sync_query = full_sync_query
+        self._sync_lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with self._connect() as db:
+            db.executescript(SCHEMA)
+
+    def _connect(self):
+        db = sqlite3.connect(self.path)
+        db.row_factory = sqlite3.Row
+        return db
+
+    def _history_id(self, db):
+        row = db.execute("SELECT value FROM state WHERE key = 'history_id'").fetchone()
+        return row['value'] if row else None
+
+    @staticmethod
+    def _store(db, records):
+        for record in records:
+            db.execute(f"INSERT OR REPLACE INTO messages ({', '.join(COLUMNS)}) "
+                       f"VALUES ({', '.join('?' * len(COLUMNS))})",
+                       [int(record[c]) if c == 'unread' else record[c] for c in COLUMNS])
+            db.execute("DELETE FROM message_labels WHERE message_id = ?", (record['id'],))
+            db.executemany("INSERT INTO message_labels (message_id, label) VALUES (?, ?)",
+                           [(record['id'], label) for label in record['labels']])
+
+    @staticmethod
+    def _delete(db, message_ids):
+        db.executemany("DELETE FROM messages WHERE id = ?", [(i,) for i in message_ids])
+        db.executemany("DELETE FROM message_labels WHERE message_id = ?", [(i,) for i in message_ids])
+
+    def full_sync(self, service):
+        """
+        Rebuilds the index from all the messages (of full_sync_query).
+        If messages still fail after the batch retries, the error is raised and nothing is saved.
+        """
+        # Take the historyId first, changes made during the sync are applied by the next incremental sync
+        history_id = service.users().getProfile(userId='me').execute()['historyId']
+        records = get_messages_metadata(service, list_message_ids(service, self.full_sync_query), strict=True)
+
+        with self._connect() as db:
+            db.execute("DELETE FROM messages")
+            db.execute("DELETE FROM message_labels")
+            self._store(db, records)
+            db.execute("INSERT OR REPLACE INTO state (key, value) VALUES ('history_id', ?)", (str(history_id),))
+
+    def incremental_sync(self, service, history_id):
+        """ Applies the changes since history_id. When nothing changed this is one small API call """
+        changed = set()
+        deleted = set()
+        page_token = None
+
+        while True:
+            results = service.users().history().list(userId='me', startHistoryId=history_id,
+                                                      pageToken=page_token).execute()
+            for history in results.get('history', []):
+                for change in history.get('messagesAdded', []) + history.get('labelsAdded', []) \
+                        + history.get('labelsRemoved', []):
+                    changed.add(change['message']['id'])
+                for change in history.get('messagesDeleted', []):
+                    deleted.add(change['message']['id'])
+
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                new_history_id = results.get('historyId', history_id)
+                break
+
+        changed -= deleted
+        records = get_messages_metadata(service, list(changed), strict=True) if changed else []
+
+        # Moving a message to trash / spam is a label change, it leaves the index like a deleted message
+        excluded = [record for record in records if EXCLUDED_LABELS & set(record['labels'])]
+        deleted.update(record['id'] for record in excluded)
+        records = [record for record in records if record not in excluded]
+
+        with self._connect() as db:
+            self._delete(db, deleted)
+            self._store(db, records)
+            db.execute("INSERT OR REPLACE INTO state (key, value) VALUES ('history_id', ?)",
+                       (str(new_history_id),))
+
+    def sync(self, service):
+        """ Brings the index up to date, with a full sync the first time or if the history expired """
+        with self._sync_lock:
+            with self._connect() as db:
+                history_id = self._history_id(db)
+
+            if history_id is None:
+                self.full_sync(service)
+                return
+
+            try:
+                self.incremental_sync(service, history_id)
+            except HttpError as error:
+                # Gmail keeps history for a limited time only, an old historyId gives 404
+                if error.resp.status != 404:
+                    raise
+                self.full_sync(service)
+
+    def _query(self, where='1', params=(), limit=None):
+        sql = f"SELECT * FROM messages WHERE {where} ORDER BY internal_date DESC"
+        if limit is not None:
+            sql += f" LIMIT {int(limit)}"
+        with self._connect() as db:
+            rows = db.execute(sql, params).fetchall()
+            records = []
+            for row in rows:
+                record = dict(row)
+                record['unread'] = bool(record['unread'])
+                record['labels'] = [r['label'] for r in db.execute(
+                    "SELECT label FROM message_labels WHERE message_id = ?", (record['id'],))]
+                records.append(record)
+        return records
+
+    def unread(self, limit=None):
+        """ Unread messages, newest first """
+        return self._query("unread = 1", limit=limit)
+
+    def recent(self, limit=5):
+        """ The newest messages of the inbox / updates """
+        placeholders = ', '.join('?' * len(RECENT_LABELS))
+        return self._query(f"id IN (SELECT message_id FROM message_labels WHERE label IN ({placeholders}))",
+                           RECENT_LABELS, limit)
+
+    def search(self, text, limit=None):
+        """ Messages whose subject, sender or snippet contain text, newest first """
+        pattern = f'%{text}%'
+        return self._query("subject LIKE ? OR sender LIKE ? OR snippet LIKE ?",
+                           (pattern, pattern, pattern), limit)
@@ -12,7 +12,12 @@ morning_expenses_page = st.Page(
     page='views/expenses.py'
 )
 
-pages = [login_page, morning_expenses_page]
+analytics_page = st.Page(
+    title='Analytics',
+    page='views/analytics.py'
+)
+
+pages = [login_page, morning_expenses_page, analytics_page]
 
 pg = st.navigation(pages=pages, position='sidebar')
 pg.run()
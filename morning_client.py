@@ -0,0 +1,217 @@
+"""
+This file holds the client for all HTTP traffic to morning: the API and the document downloads.
+
+One pooled session, timeout budgets per kind of call, retries of transient failures with
+jittered backoff, a client-side rate limit and the cached JWT token.
+"""
+
+import os
+import json
+import time
+import base64
+import threading
+from dotenv import load_dotenv
+
+import requests
+from requests.adapters import HTTPAdapter
+from tenacity import Retrying, retry_if_exception_type, stop_after_attempt, wait_random_exponential
+
+
+# Refresh the cached JWT this many seconds before it actually expires
+TOKEN_REFRESH_MARGIN = 60
+# Lifetime assumed for tokens whose payload carries no 'exp' claim
+TOKEN_DEFAULT_TTL = 300
+
+# (connect, read) timeouts in seconds per kind of call
+TOKEN_TIMEOUT = (5, 15)
+API_TIMEOUT = (5, 30)
+DOWNLOAD_TIMEOUT = (5, 30)
+
+# Transient failures are retried up to RETRY_ATTEMPTS times in total, with jittered exponential backoff
+RETRY_ATTEMPTS = 4
+RETRY_WAIT_MULTIPLIER = 0.5
+RETRY_WAIT_MAX = 8
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Client-side rate limit (requests per second, burst), can be set with MORNING_RATE_LIMIT / MORNING_RATE_BURST
+DEFAULT_RATE_LIMIT = 20
+DEFAULT_RATE_BURST = 20
+# Connections kept open per host
+POOL_SIZE = 16
+
+_client = None
+_client_lock = threading.Lock()
+
+
+class TransientResponseError(Exception):
+    """ A response with a status that is worth retrying (429 / 5xx) """
+
+    def __init__(self, response):
+        super().__init__(f'{response.status_code} from {response.url}')
+        self.response = response
+
+
+def token_expiry(token):
+    """ Returns the 'exp' claim (epoch seconds) of a JWT, or None if it can't be read """
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)  # restore base64 padding
+        return float(json.loads(base64.urlsafe_b64decode(payload))['exp'])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return None
+
+
+class TokenManager:
+    """
+    Process-wide cache of the morning JWT token.
+
+    The cached token is handed out until shortly before it expires. When a refresh is
+    needed only one caller fetches the new token, the others wait for it and reuse it.
+    """
+
+    def __init__(self, fetch, refresh_margin=TOKEN_REFRESH_MARGIN):
+        self._fetch = fetch
+        self._refresh_margin = refresh_margin
+        self._lock = threading.Lock()
+        self._token = None
+        self._expires_at = 0.0
+
+    def _is_fresh(self):
+        return self._token is not None and time.time() < self._expires_at - self._refresh_margin
+
+    def get(self):
+        """ Returns a valid token, fetching a new one only if the cached one is (nearly) expired """
+        if self._is_fresh():
+            return self._token
+
+        with self._lock:
+            # Another thread may have refreshed the token while we waited for the lock
+            if not self._is_fresh():
+                token = self._fetch()
+                expires_at = token_expiry(token)
+                if expires_at is None:
+                    expires_at = time.time() + TOKEN_DEFAULT_TTL
+                self._token, self._expires_at = token, expires_at
+            return self._token
+
+    def invalidate(self, token=None):
+        """
+        Drops the cached token. If a token is given, it is dropped only if it is still
+        the cached one, so a token that was already refreshed by another thread is kept.
+        """
+        with self._lock:
+            if token is None or token == self._token:
+                self._token = None
+                self._expires_at = 0.0
+
+
+class RateLimiter:
+    """ Token bucket: at most burst requests at once, refilled at rate requests per second """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """ Waits until a request may be sent """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class MorningClient:
+    """ All requests to morning go through this client """
+
+    def __init__(self, rate=DEFAULT_RATE_LIMIT, burst=DEFAULT_RATE_BURST, pool_size=POOL_SIZE):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.rate_limiter = RateLimiter(rate, burst)
+        self.tokens = TokenManager(self._fetch_token)
+
+    def request(self, method, url, timeout, **kwargs):
+        """
+        Sends a request within the rate limit. Connection errors, timeouts and 429 / 5xx answers
+        are retried with jittered exponential backoff; the last response (or error) is returned (raised).
+        """
+        def send():
+            self.rate_limiter.acquire()
+            response = self.session.request(method, url, timeout=timeout, **kwargs)
+            if response.status_code in RETRY_STATUSES:
+                response.close()
+                raise TransientResponseError(response)
+            return response
+
+        retrying = Retrying(
+            retry=retry_if_exception_type((requests.ConnectionError, requests.Timeout, TransientResponseError)),
+            wait=wait_random_exponential(multiplier=RETRY_WAIT_MULTIPLIER, max=RETRY_WAIT_MAX),
+            stop=stop_after_attempt(RETRY_ATTEMPTS),
+            reraise=True,
+        )
+        try:
+            return retrying(send)
+        except TransientResponseError as error:
+            return error.response
+
+    def _fetch_token(self):
+        """ Getting a fresh JWT token from morning """
+        load_dotenv()
+        data = {
+            "id": os.getenv('MORNING_API_KEY'),
+            "secret": os.getenv('MORNING_SECRET')
+        }
+        headers = {
+            'Content-Type': 'application/json'
+        }
+        response = self.request('POST', os.getenv('TOKEN_URL'), TOKEN_TIMEOUT,
+                                data=json.dumps(data), headers=headers)
+        return response.json()['token']
+
+    def token(self):
+        """ Returns the JWT token (cached until shortly before it expires) """
+        return self.tokens.get()
+
+    def post(self, url, data=None, timeout=API_TIMEOUT):
+        """
+        POST to a morning endpoint with the cached JWT token.
+        If morning answers 401 the token is refreshed and the request is retried once.
+        """
+        token = self.token()
+        headers = {
+            'Content-Type': 'application/json',
+            'Authorization': f'Bearer {token}'
+        }
+        response = self.request('POST', url, timeout, data=data, headers=headers)
+
+        if response.status_code == 401:
+            self.tokens.invalidate(token)
+            headers['Authorization'] = f'Bearer {self.token()}'
+            response = self.request('POST', url, timeout, data=data, headers=headers)
+
+        return response
+
+    def get(self, url, timeout=DOWNLOAD_TIMEOUT, stream=False):
+        """ GET a document (document urls need no token) """
+        return self.request('GET', url, timeout, stream=stream)
+
+
+def get_client():
+    """ Returns the process-wide morning client """
+    global _client
+    with _client_lock:
+        if _client is None:
+            load_dotenv()
+            _client = MorningClient(rate=float(os.getenv('MORNING_RATE_LIMIT', DEFAULT_RATE_LIMIT)),
+                                    burst=int(os.getenv('MORNING_RATE_BURST', DEFAULT_RATE_BURST)))
+        return _client
@@ -0,0 +1,49 @@
+"""
+This file holds the cached data layer of the Streamlit pages.
+
+Morning data is cached per reporting period and shared across sessions, for MORNING_DATA_TTL
+seconds, so page reruns that don't change the period don't touch the network.
+"""
+
+import streamlit as st
+
+from analytics import documents_frame
+from expense_data import reopen_ledger, morning_items, report_period, reconcile_range, PeriodSnapshot
+
+
+# Seconds Morning data is served from the cache before it is fetched again
+MORNING_DATA_TTL = 600
+
+
+@st.cache_data(ttl=MORNING_DATA_TTL, show_spinner=False)
+def period_data(kind, from_date, to_date):
+    """ The morning docs ('incomes' / 'expenses') between two dates, in the shape of get_incomes / get_expenses """
+    return {'items': list(morning_items(kind, from_date, to_date))}
+
+
+@st.cache_data(ttl=MORNING_DATA_TTL, show_spinner=False)
+def range_reconciliation(from_date, to_date):
+    """ Cached expense_data.reconcile_range """
+    return reconcile_range(from_date, to_date)
+
+
+@st.cache_data(ttl=MORNING_DATA_TTL, show_spinner=False)
+def expenses_frame(from_date, to_date):
+    """ The expenses between two dates as an analytics.documents_frame table """
+    return documents_frame(period_data('expenses', from_date, to_date)['items'])
+
+
+def page_snapshot():
+    """ A PeriodSnapshot that reads through the cross-session cache """
+    def fetcher(kind):
+        return lambda date=None: period_data(kind, *report_period(date))
+
+    return PeriodSnapshot({'expenses': fetcher('expenses'), 'incomes': fetcher('incomes')})
+
+
+def refresh_morning_data():
+    """ Drops all cached morning data and reopens the ledger's periods, the next access fetches them again """
+    reopen_ledger()
+    period_data.clear()
+    range_reconciliation.clear()
+    expenses_frame.clear()
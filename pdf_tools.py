@@ -0,0 +1,217 @@
+"""
+This file holds the functions for merging documents into one pdf.
+"""
+
+import os
+import time
+import tempfile
+import pymupdf
+from io import BytesIO
+from dotenv import load_dotenv
+
+
+# When merging to disk, the merged pdf is written out (and released from memory) every this many documents
+MERGE_FLUSH_EVERY = 20
+
+# Optimization: images above IMAGE_DPI * IMAGE_DPI_THRESHOLD_FACTOR are downsampled to IMAGE_DPI
+DEFAULT_IMAGE_DPI = 150
+IMAGE_DPI_THRESHOLD_FACTOR = 1.5
+IMAGE_JPEG_QUALITY = 80
+
+# Save options of an optimized pdf: drop unused and duplicate objects, compress all streams
+OPTIMIZED_SAVE_OPTIONS = {
+    'garbage': 4,
+    'deflate': True,
+    'deflate_images': True,
+    'deflate_fonts': True,
+    'clean': True,
+    'use_objstms': 1,
+}
+
+
+def merge_to_disk():
+    """ True if reports should be merged on disk (PDF_MERGE_TO_DISK=1), to keep memory use flat """
+    load_dotenv()
+    return os.getenv('PDF_MERGE_TO_DISK', '0') == '1'
+
+
+def optimize_settings():
+    """
+    Returns (optimize, image_dpi) from the PDF_OPTIMIZE (1 to optimize) and PDF_IMAGE_DPI
+    (0 keeps the images as they are) env variables
+    """
+    load_dotenv()
+    optimize = os.getenv('PDF_OPTIMIZE', '0') == '1'
+    image_dpi = int(os.getenv('PDF_IMAGE_DPI', DEFAULT_IMAGE_DPI))
+    return optimize, image_dpi
+
+
+def downsample_images(pdf, image_dpi):
+    """
+    Re-encodes as JPEG, at image_dpi, the images of pdf shown above image_dpi * IMAGE_DPI_THRESHOLD_FACTOR.
+    Images with transparency are kept as they are. Returns the number of images rewritten.
+    """
+    threshold = image_dpi * IMAGE_DPI_THRESHOLD_FACTOR
+    seen = set()
+    rewritten = 0
+
+    for page in pdf:
+        for info in page.get_image_info(xrefs=True):
+            xref = info['xref']
+            width = info['bbox'][2] - info['bbox'][0]
+            if xref <= 0 or xref in seen or width <= 0:
+                continue
+            seen.add(xref)
+
+            # Effective DPI: image pixels per inch of the area it is shown in (72 points per inch)
+            dpi = info['width'] * 72 / width
+            if dpi <= threshold or pdf.xref_get_key(xref, 'SMask')[0] != 'null':
+                continue
+            scale = image_dpi / dpi
+
+            pix = pymupdf.Pixmap(pdf, xref)
+            if pix.alpha:
+                continue
+            if pix.n > 3:
+                pix = pymupdf.Pixmap(pymupdf.csRGB, pix)
+            pix = pymupdf.Pixmap(pix, max(1, round(pix.width * scale)), max(1, round(pix.height * scale)), None)
+            page.replace_image(xref, stream=pix.tobytes('jpg', jpg_quality=IMAGE_JPEG_QUALITY))
+            rewritten += 1
+
+    return rewritten
+
+
+def optimize_pdf(buffer, image_dpi=DEFAULT_IMAGE_DPI):
+    """
+    Makes a merged pdf smaller before it is attached: downsamples high-DPI images to image_dpi
+    (0 to keep them), subsets and deduplicates fonts, removes duplicate objects and deflates all streams.
+
+    buffer is a BytesIO or an open binary file, the result is of the same kind at position 0.
+    The original buffer is returned if optimizing doesn't make it smaller.
+    """
+    start = time.perf_counter()
+    buffer.seek(0, os.SEEK_END)
+    size_before = buffer.tell()
+    buffer.seek(0)
+
+    pdf = pymupdf.open("pdf", buffer.read())
+    if image_dpi:
+        downsample_images(pdf, image_dpi)
+    pdf.subset_fonts()
+
+    if isinstance(buffer, BytesIO):
+        output = BytesIO()
+        pdf.save(output, **OPTIMIZED_SAVE_OPTIONS)
+    else:
+        output = saved_to_temp_file(pdf, **OPTIMIZED_SAVE_OPTIONS)
+    pdf.close()
+    output.seek(0, os.SEEK_END)
+    size_after = output.tell()
+
+    print(f"Optimized pdf: {size_before / 1024:.0f}KB -> {size_after / 1024:.0f}KB "
+          f"in {time.perf_counter() - start:.1f}s")
+
+    if size_after >= size_before:
+        output.close()
+        buffer.seek(0)
+        return buffer
+
+    buffer.close()
+    output.seek(0)
+    return output
+
+
+def saved_to_temp_file(pdf, **options):
+    """
+    Saves pdf to a temp file and returns it open for reading. pymupdf only saves to a path
+    or a BytesIO, so the pdf is saved to a named temp file that is removed once it is open.
+    """
+    fd, path = tempfile.mkstemp(suffix='.pdf')
+    os.close(fd)
+    try:
+        pdf.save(path, **options)
+        return open(path, 'rb')
+    finally:
+        # The open file stays readable after the path is removed
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def merge_pdfs(contents):
+    """
+    Merges pdf documents (bytes) into one pdf buffer, in the given order.
+    Missing documents (None) are skipped.
+    """
+    # Create an empty PDF
+    merged_pdf = pymupdf.open()
+
+    for content in contents:
+        if content is None:
+            continue
+        # Load PDF from memory and append its pages to the merged PDF
+        pdf = pymupdf.open("pdf", content)
+        merged_pdf.insert_pdf(pdf)
+
+    # Save combined PDF to memory (BytesIO)
+    buffer = BytesIO()
+    merged_pdf.save(buffer)
+    buffer.seek(0)
+
+    return buffer
+
+
+def merge_pdf_files(files, flush_every=MERGE_FLUSH_EVERY):
+    """
+    Merges pdf documents (open binary files) into one pdf saved in a temp file, in the given order.
+
+    Every source file is appended and closed right away, and the merged pdf is saved
+    incrementally and reopened every flush_every documents, so memory use does not grow
+    with the number of documents. Missing documents (None) are skipped.
+
+    Returns the merged pdf as an open binary file at position 0.
+    """
+    fd, path = tempfile.mkstemp(suffix='.pdf')
+    os.close(fd)
+
+    merged_pdf = pymupdf.open()
+    saved = False  # merged_pdf was saved to path and reopened from it
+    pending = 0  # documents appended since the last save
+
+    try:
+        for file in files:
+            if file is None:
+                continue
+            with file:
+                pdf = pymupdf.open("pdf", file.read())
+            merged_pdf.insert_pdf(pdf)
+            pdf.close()
+            pending += 1
+
+            if pending >= flush_every:
+                if saved:
+                    merged_pdf.saveIncr()
+                else:
+                    merged_pdf.save(path)
+                    saved = True
+                # Reopen from disk, pages are then only loaded when needed
+                merged_pdf.close()
+                merged_pdf = pymupdf.open(path)
+                pending = 0
+
+        if not saved:
+            merged_pdf.save(path)
+        elif pending:
+            merged_pdf.saveIncr()
+        merged_pdf.close()
+
+        output = open(path, 'rb')
+    finally:
+        # The open file stays readable after the path is removed
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    return output
@@ -0,0 +1,54 @@
+"""
+This file holds a small runner for dependency graphs of tasks.
+
+Every task starts as soon as the tasks it depends on are finished, so independent branches
+run concurrently and the total time approaches that of the slowest branch.
+"""
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+def run_graph(tasks, max_workers=None):
+    """
+    Runs a graph of tasks.
+
+    Args:
+        tasks: {name: (func, [names of the tasks it depends on])}. func is called with the
+               results of its dependencies, in the order they are listed.
+        max_workers: Number of threads, by default one per task.
+
+    Returns:
+        dict: {name: result}. The first exception raised by a task is raised again, tasks that
+              have not started yet are then not run.
+    """
+    for name, (_, dependencies) in tasks.items():
+        unknown = [d for d in dependencies if d not in tasks]
+        if unknown:
+            raise ValueError(f'Task {name} depends on unknown tasks: {unknown}')
+
+    results = {}
+    waiting = dict(tasks)
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=max_workers or len(tasks) or 1) as executor:
+        while waiting or running:
+            # Start every task whose dependencies are done
+            for name, (func, dependencies) in list(waiting.items()):
+                if all(d in results for d in dependencies):
+                    running[executor.submit(func, *(results[d] for d in dependencies))] = name
+                    del waiting[name]
+
+            if not running:
+                raise ValueError(f'Tasks with circular dependencies: {list(waiting)}')
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                error = future.exception()
+                if error is not None:
+                    for other in running:
+                        other.cancel()
+                    raise error
+                results[name] = future.result()
+
+    return results
@@ -0,0 +1,67 @@
+"""
+This file holds the reconciliation of the period's bills against the expected bills per supplier.
+"""
+
+from collections import Counter, namedtuple
+
+
+# actual and expected number of bills of a supplier in a reporting period
+BillCount = namedtuple('BillCount', ['supplier', 'actual', 'expected'])
+
+# lacking - expected suppliers without any bill, shorts - suppliers with less bills than expected
+Reconciliation = namedtuple('Reconciliation', ['lacking', 'shorts'])
+
+
+def supplier_name(item):
+    """ Returns the supplier name of an expense doc, or None """
+    return (item.get('supplier') or {}).get('name')
+
+
+def count_bills(items):
+    """ Counts the expense docs per supplier in one pass """
+    return Counter(name for name in map(supplier_name, items) if name is not None)
+
+
+def reconcile_counts(counts, expected):
+    """
+    Compares the number of bills per supplier with the expected number of bills.
+
+    Args:
+        counts: Mapping {supplier: number of bills}.
+        expected: Mapping {supplier: expected number of bills}, see expense_data.expense_dict.
+
+    Returns:
+        Reconciliation: each supplier appears at most once, in the order of expected.
+    """
+    lacking = []
+    shorts = []
+    for supplier, expected_count in expected.items():
+        actual = counts.get(supplier, 0)
+        if actual == 0:
+            lacking.append(BillCount(supplier, actual, expected_count))
+        elif actual < expected_count:
+            shorts.append(BillCount(supplier, actual, expected_count))
+
+    return Reconciliation(lacking, shorts)
+
+
+def reconcile_expenses(items, expected):
+    """ Reconciles the expense docs of a reporting period against the expected bills """
+    return reconcile_counts(count_bills(items), expected)
+
+
+def missing_bills_matrix(reconciliations):
+    """
+    Turns {period: Reconciliation} into a period × supplier matrix of missing and short bills.
+
+    Returns:
+        dict: {supplier: {period: 'missing' / 'actual/expected'}}, only suppliers and periods
+              with missing or short bills are included.
+    """
+    matrix = {}
+    for period, reconciliation in reconciliations.items():
+        for bill in reconciliation.lacking:
+            matrix.setdefault(bill.supplier, {})[period] = 'missing'
+        for bill in reconciliation.shorts:
+            matrix.setdefault(bill.supplier, {})[period] = f'{bill.actual}/{bill.expected}'
+    return matrix
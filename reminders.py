@@ -0,0 +1,152 @@
+"""
+This file holds the calendar reminders for expected supplier bills and report deadlines.
+
+The full set of reminders of a year is computed locally and compared with the reminders
+already in the calendar, and only the differences are created / updated / deleted, in batches.
+"""
+
+import datetime
+
+from expense_data import expense_dict, periods_between
+
+
+# Reminders are marked with these private extended properties: the source (to find them)
+# and the reminder key (to match them with the expected reminders)
+SOURCE_PROPERTY = 'pa_source'
+SOURCE = 'personal_assistant'
+REMINDER_PROPERTY = 'pa_reminder'
+# report_period keeps showing the previous period until this day of the month
+REPORT_DEADLINE_DAY = 10
+# Calendar requests per batch (Google allows at most 1000, advises 50)
+BATCH_SIZE = 50
+
+
+def all_day(date):
+    """ Start and end of an all-day event on date """
+    next_day = date + datetime.timedelta(days=1)
+    return {'start': {'date': date.isoformat()}, 'end': {'date': next_day.isoformat()}}
+
+
+def reminder_event(key, summary, description, date):
+    """ The calendar event body of a reminder """
+    event = {
+        'summary': summary,
+        'description': description,
+        'extendedProperties': {'private': {SOURCE_PROPERTY: SOURCE, REMINDER_PROPERTY: key}},
+    }
+    event.update(all_day(date))
+    return event
+
+
+def year_reminders(year):
+    """
+    Returns {key: event} with a reminder for every expected supplier bill (on the last day of
+    each reporting period) and for the report deadline of every reporting period of the year
+    """
+    reminders = {}
+    for start, end in periods_between(f'{year}-01-01', f'{year}-12-31'):
+        end_date = datetime.date.fromisoformat(end)
+
+        for supplier, expected in expense_dict().items():
+            if expected > 0:
+                key = f'bill:{start}:{supplier}'
+                reminders[key] = reminder_event(key, f'Bill: {supplier}',
+                                                f'Expected bills for {start} - {end}: {expected}', end_date)
+
+        deadline = (end_date + datetime.timedelta(days=1)).replace(day=REPORT_DEADLINE_DAY)
+        key = f'deadline:{start}'
+        reminders[key] = reminder_event(key, 'Report to accountant',
+                                        f'Report deadline for {start} - {end}', deadline)
+
+    return reminders
+
+
+def reminder_year(key):
+    """ The year of the reporting period a reminder key belongs to ('bill:2025-11-01:...' -> 2025) """
+    return int(key.split(':')[1][:4])
+
+
+def existing_reminders(service, year, calendar_id='primary'):
+    """
+    Returns the reminder events in the calendar from the start of the year up to February after it
+    (incl. the deadline in January after it). The listing also holds the previous year's last deadline.
+    """
+    events = []
+    page_token = None
+    while True:
+        results = service.events().list(
+            calendarId=calendar_id,
+            timeMin=f'{year}-01-01T00:00:00Z',
+            timeMax=f'{year + 1}-02-01T00:00:00Z',
+            privateExtendedProperty=f'{SOURCE_PROPERTY}={SOURCE}',
+            singleEvents=True,
+            maxResults=2500,
+            pageToken=page_token
+        ).execute()
+        events.extend(e for e in results.get('items', [])
+                      if REMINDER_PROPERTY in e.get('extendedProperties', {}).get('private', {}))
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            return events
+
+
+def _changed(existing, desired):
+    return any(existing.get(field) != desired[field] for field in ('summary', 'description')) \
+        or existing['start'].get('date') != desired['start']['date'] \
+        or existing['end'].get('date') != desired['end']['date']
+
+
+def _execute_batches(service, requests):
+    """ Executes the requests in batches, returns the number of failed requests """
+    errors = []
+
+    def callback(request_id, response, exception):
+        if exception is not None:
+            print(f"An error occurred: {exception}")
+            errors.append(request_id)
+
+    for i in range(0, len(requests), BATCH_SIZE):
+        batch = service.new_batch_http_request(callback=callback)
+        for request in requests[i:i + BATCH_SIZE]:
+            batch.add(request)
+        batch.execute()
+
+    return len(errors)
+
+
+def sync_reminders(service, year, calendar_id='primary'):
+    """
+    Makes the calendar hold exactly the reminders of the year: creates missing ones,
+    updates changed ones and deletes reminders that are no longer expected (or duplicated).
+    Reminders of other years' periods are left alone, so syncing one year never undoes another.
+    Running it again without changes sends no requests besides the listing.
+
+    Returns:
+        dict: number of 'created', 'updated', 'deleted' and 'failed' events.
+    """
+    desired = year_reminders(year)
+    existing = {}
+    requests = []
+    counts = {'created': 0, 'updated': 0, 'deleted': 0}
+
+    events = service.events()
+    for event in existing_reminders(service, year, calendar_id):
+        key = event['extendedProperties']['private'][REMINDER_PROPERTY]
+        if reminder_year(key) != year:
+            continue
+        if key in desired and key not in existing:
+            existing[key] = event
+        else:
+            requests.append(events.delete(calendarId=calendar_id, eventId=event['id']))
+            counts['deleted'] += 1
+
+    for key, event in desired.items():
+        if key not in existing:
+            requests.append(events.insert(calendarId=calendar_id, body=event))
+            counts['created'] += 1
+        elif _changed(existing[key], event):
+            requests.append(events.patch(calendarId=calendar_id, eventId=existing[key]['id'], body=event))
+            counts['updated'] += 1
+
+    counts['failed'] = _execute_batches(service, requests)
+    return counts
@@ -0,0 +1,99 @@
+"""
+This file holds the background runner of report jobs.
+
+Reports run off the Streamlit script thread, report their progress per stage and outlive
+page reruns (the runner lives for the whole process). Only one job per key (reporting
+period) can run at a time.
+"""
+
+import time
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+# Number of report jobs (for different periods) that may run at the same time
+MAX_CONCURRENT_JOBS = 2
+
+_runner = None
+_runner_lock = threading.Lock()
+
+
+class ReportJob:
+    """ State and progress of one report job """
+
+    def __init__(self, key):
+        self.key = key
+        self.status = RUNNING
+        self.error = None
+        self.started_at = time.time()
+        self.finished_at = None
+        self._stages = {}  # stage -> (done, total), in the order the stages started
+        self._lock = threading.Lock()
+
+    def progress(self, stage, done, total):
+        """ Progress callback given to the report: done out of total in a stage """
+        with self._lock:
+            self._stages[stage] = (done, total)
+
+    def stages(self):
+        """ Returns [(stage, done, total)] """
+        with self._lock:
+            return [(stage, done, total) for stage, (done, total) in self._stages.items()]
+
+    @property
+    def running(self):
+        return self.status == RUNNING
+
+
+class ReportJobRunner:
+    """ Runs report jobs on a thread pool, at most one running job per key """
+
+    def __init__(self, max_workers=MAX_CONCURRENT_JOBS):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='report')
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def _run(self, job, func, args, kwargs):
+        try:
+            func(*args, progress=job.progress, **kwargs)
+            job.status = DONE
+        except Exception as error:
+            traceback.print_exc()
+            job.error = error
+            job.status = FAILED
+        finally:
+            job.finished_at = time.time()
+
+    def submit(self, key, func, *args, **kwargs):
+        """
+        Starts func(*args, progress=..., **kwargs) in the background, unless a job with the same
+        key is still running. Returns (job, started): the new job, or the running one and False.
+        """
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is not None and job.running:
+                return job, False
+
+            job = ReportJob(key)
+            self._jobs[key] = job
+            self._executor.submit(self._run, job, func, args, kwargs)
+            return job, True
+
+    def get(self, key):
+        """ Returns the last job with the key, or None """
+        with self._lock:
+            return self._jobs.get(key)
+
+
+def get_runner():
+    """ Returns the process-wide report job runner """
+    global _runner
+    with _runner_lock:
+        if _runner is None:
+            _runner = ReportJobRunner()
+        return _runner
@@ -0,0 +1,40 @@
+import streamlit as st
+from datetime import datetime
+
+from analytics import supplier_totals, period_totals, supplier_period_totals
+from page_data import expenses_frame, refresh_morning_data
+
+
+def past_year_options():
+    """ The current year and the 5 years before it (the years that can have expenses to analyse) """
+    current_year = datetime.now().year
+    return list(range(current_year - 5, current_year + 1))
+
+
+st.title('Expense Analytics')
+
+if st.button('Refresh from Morning'):
+    refresh_morning_data()
+
+years = past_year_options()
+from_year, to_year = st.select_slider('Years', options=years, value=(years[-1], years[-1]))
+
+with st.spinner('Loading expenses...'):
+    frame = expenses_frame(f'{from_year}-01-01', f'{to_year}-12-31')
+
+if frame.empty:
+    st.write('No Expenses')
+    st.stop()
+
+by_period = period_totals(frame)
+st.subheader('Expenses by Period:')
+st.bar_chart(by_period['sum'])
+
+by_supplier = supplier_totals(frame)
+st.subheader('Expenses by Supplier:')
+st.dataframe(by_supplier.rename(columns={'sum': 'Total', 'count': 'Expenses'}))
+
+st.subheader('Supplier Trend:')
+suppliers = st.multiselect('Suppliers', options=list(by_supplier.index), default=list(by_supplier.index[:5]))
+if suppliers:
+    st.line_chart(supplier_period_totals(frame).loc[suppliers].T)
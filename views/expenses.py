@@ -1,9 +1,13 @@
 import streamlit as st
+import pandas as pd
 from datetime import datetime
 import calendar
 
-from expense_data import check_number_of_expenses, report_period
+from expense_data import reconcile_period, report_period
+from reconciliation import missing_bills_matrix
+from page_data import page_snapshot, range_reconciliation, refresh_morning_data
 from accountant import report_to_accountant
+from report_jobs import get_runner, DONE, FAILED
 
 
 def dates(date=None):
@@ -30,7 +34,21 @@ def make_new_report_date(year, months):
     return f'{year}-{last_month}-{last_day}'
 
 
+def period_label(period):
+    """ Short name of a reporting period, e.g. Jan-Feb """
+    start, end = (datetime.strptime(d, '%Y-%m-%d').strftime('%b') for d in period)
+    return f'{start}-{end}'
+
+
 ############# PAGE #############
+# Morning data is cached per period across reruns, this button fetches it again
+if st.button('Refresh from Morning'):
+    refresh_morning_data()
+
+# Morning data used during this run of the page, shared with the report
+snapshot = page_snapshot()
+
+
 def show_results(date=None):
     with st.container():
         st.subheader('Reporting Period:')
@@ -38,17 +56,17 @@ def show_results(date=None):
         st.write(f'{start}-{end}, {year}')
         st.divider()
 
-        lacking, shorts = check_number_of_expenses(date)
+        lacking, shorts = reconcile_period(date, snapshot)
         st.subheader('Companies lacking bills altogether:')
         if len(lacking) > 0:
-            for company in lacking:
-                st.write(company)
+            for bill in lacking:
+                st.write(bill.supplier)
         else:
             st.write('No Companies')
         st.subheader('Companies with less bills than expected:')
         if len(shorts) > 0:
-            for company in shorts:
-                st.write(company)
+            for bill in shorts:
+                st.write(f'{bill.supplier} ({bill.actual} of {bill.expected})')
         else:
             st.write('No Companies')
 
@@ -60,8 +78,38 @@ start, end, year = show_results()
 st.divider()
 
 st.subheader(':blue[Report to Accountant:]')
+# The report runs in the background, its progress is shown below and survives reruns
+report_key = (start, end, year)
 if st.button('Report'):
-    report_to_accountant(start, end, year)
+    job, started = get_runner().submit(report_key, report_to_accountant, start, end, year, snapshot=snapshot)
+    if not started:
+        st.warning('A report for this period is already being sent')
+
+
+def show_report_progress(job):
+    for stage, done, total in job.stages():
+        st.progress(done / total if total else 1.0, text=f'{stage}: {done}/{total}')
+
+    if job.status == DONE:
+        st.success('Report sent')
+    elif job.status == FAILED:
+        st.error(f'Report failed: {job.error}')
+
+
+# Only a running job is polled, a finished one is shown once by the full rerun
+@st.fragment(run_every=1)
+def poll_report_progress():
+    job = get_runner().get(report_key)
+    if job is None or not job.running:
+        st.rerun()
+    show_report_progress(job)
+
+
+report_job = get_runner().get(report_key)
+if report_job is not None and report_job.running:
+    poll_report_progress()
+elif report_job is not None:
+    show_report_progress(report_job)
 
 
 st.divider()
@@ -84,4 +132,20 @@ with st.form(key='change_report', clear_on_submit=True):
     else:
         st.error('Choose Year and Months')
 
-
+# Option to check bills status for a whole year at once
+with st.form(key='audit_year'):
+    st.subheader('Audit a Year:')
+    audit_year = st.selectbox('Choose Year', options=year_options_list(), index=None,
+                              placeholder='Choose a year')
+
+    audit_submitted = st.form_submit_button('Audit')
+    if audit_year is not None and audit_submitted:
+        reconciliations = range_reconciliation(f'{audit_year}-01-01', f'{audit_year}-12-31')
+        matrix = missing_bills_matrix(reconciliations)
+        if matrix:
+            rows = {supplier: {period_label(period): status for period, status in row.items()}
+                    for supplier, row in matrix.items()}
+            columns = [period_label(period) for period in reconciliations]
+            st.dataframe(pd.DataFrame.from_dict(rows, orient='index', columns=columns).fillna(''))
+        else:
+            st.write('No Companies')